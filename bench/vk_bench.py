@@ -0,0 +1,853 @@
+# -*- coding: utf8 -*-
+# Headless benchmarks for the vk plugin.
+#
+# Runs VKSource and VkontakteSearch from ../vk.py without Rhythmbox and without a vk account:
+#  - the gi modules (RB, Gtk, GLib...) are replaced by stubs, RhythmDB by a stub counting its calls
+#    and GLib's main loop by a queue pumped by the benchmark;
+#  - every request to vk goes to a local fake api server, serving a synthetic catalogue with
+#    configurable latency and captchas.
+#
+# The timings come from the plugin's own search stats. Each run is appended to a JSON lines file,
+# and compared with the previous run of the same scenario.
+#
+#   python3 bench/vk_bench.py                       # all the scenarios
+#   python3 bench/vk_bench.py search --amount 1000 --latency 50 --captcha-every 20
+
+import argparse
+import collections
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import queue
+import re
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import urllib.parse
+from xml.dom import minidom
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# the fake api.vk.com
+class FakeVK:
+    def __init__(self, catalogue, latency, captcha_every):
+        self.catalogue = catalogue
+        self.latency = latency
+        self.captcha_every = captcha_every
+        # set, every request gets a captcha till one comes with the answer, as vk does for a while
+        self.captcha_needed = False
+        # the user of the token
+        self.user_id = 1
+        # how long the stream urls work, in seconds
+        self.url_lifetime = 24 * 3600
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        # the api calls, the ones inside execute included
+        self.calls = collections.Counter()
+        self.words = None
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeVKHandler)
+        self.server.daemon_threads = True
+        self.server.vk = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def track(self, i):
+        return {"aid": i + 1, "owner_id": 1000 + i % 7, "artist": "Artist %d" % (i % 500),
+                "title": "Title %d & more" % i, "duration": 120 + i % 240,
+                "url": "http://cs1.vk.me/u%d/audio/%d.mp3?expires=%d" % (
+                    1000 + i % 7, i + 1, (time.time() + self.url_lifetime) * 1000)}
+
+    # like the real ones, the stream urls stop working after a while
+    def expired(self, url):
+        return int(url.rsplit("=", 1)[1]) < time.time() * 1000
+
+    # the tracks having most of the words of the query, the best ones first, and how many there are.
+    # "artist" matches the whole catalogue, which is what a popular query looks like
+    def tracks(self, query, offset, count):
+        words = query.lower().split()
+        if not words or words == ["artist"]:
+            return self.catalogue, [self.track(i) for i in range(offset, min(self.catalogue, offset + count))]
+        with self.lock:
+            if self.words is None:
+                self.words = collections.defaultdict(set)
+                for i in range(self.catalogue):
+                    for word in ("%(artist)s %(title)s" % self.track(i)).lower().split():
+                        self.words[word].add(i)
+        # the tracks with one of the rare words of the query are the candidates
+        postings = [self.words.get(word, set()) for word in words]
+        rare = [posting for posting in postings if len(posting) < self.catalogue // 10]
+        candidates = set().union(*rare) if rare else range(self.catalogue)
+        found = []
+        for i in candidates:
+            matched = sum(i in posting for posting in postings)
+            if matched * 4 >= len(words) * 3:
+                found.append((-matched, i))
+        found.sort()
+        return len(found), [self.track(i) for matched, i in found[offset:offset + count]]
+
+    # returns (content type, body)
+    def answer(self, method, params):
+        with self.lock:
+            self.requests[method] += 1
+            total = sum(self.requests.values())
+        time.sleep(self.latency)
+        if method == "captcha":
+            return "image/jpeg", b"\xff\xd8\xff\xd9"
+        xml = method.endswith(".xml")
+        method = method[:-4] if xml else method
+        if "captcha_key" in params:
+            self.captcha_needed = False
+        elif self.captcha_needed or (self.captcha_every and total % self.captcha_every == 0):
+            error = {"error_code": 14, "error_msg": "Captcha needed", "captcha_sid": str(total),
+                     "captcha_img": "https://api.vk.com/captcha.php?sid=%d" % total}
+            return self.error(xml, error)
+        if method == "execute":
+            results = []
+            errors = []
+            for inner, inner_params in self.parse_code(params["code"]):
+                try:
+                    results.append(self.call(inner, dict((k, str(v)) for k, v in inner_params.items())))
+                except KeyError:
+                    results.append(False)
+                    errors.append({"method": inner, "error_code": 3, "error_msg": "Unknown method passed"})
+            return self.response(xml, results, errors)
+        try:
+            return self.response(xml, self.call(method, params))
+        except KeyError:
+            return self.error(xml, {"error_code": 3, "error_msg": "Unknown method passed"})
+
+    def call(self, method, params):
+        with self.lock:
+            self.calls[method] += 1
+        offset = int(params.get("offset", 0))
+        count = int(params.get("count", 100))
+        if method == "users.isAppUser":
+            return "1"
+        if method == "users.get":
+            return [{"id": self.user_id, "first_name": "Bench", "last_name": "User"}]
+        if method == "audio.search":
+            total, tracks = self.tracks(params.get("q", ""), offset, count)
+            return [total] + tracks
+        if method == "audio.get":
+            return self.tracks("", offset, count)[1]
+        if method == "audio.getById":
+            ids = [int(a.split("_")[1]) for a in params.get("audios", "").split(",") if a]
+            return [self.track(i - 1) for i in ids if 0 < i <= self.catalogue]
+        raise KeyError(method)
+
+    # the code of execute is "return [API.method({...}),API.method({...})];"
+    def parse_code(self, code):
+        decoder = json.JSONDecoder()
+        calls = []
+        for match in re.finditer(r"API\.([\w.]+)\(", code):
+            params, end = decoder.raw_decode(code, match.end())
+            calls.append((match.group(1), params))
+        return calls
+
+    def response(self, xml, value, execute_errors=None):
+        if not xml:
+            answer = {"response": value}
+            if execute_errors:
+                answer["execute_errors"] = execute_errors
+            return "application/json", json.dumps(answer).encode("utf-8")
+        if isinstance(value, str):
+            return "text/xml", ('<?xml version="1.0" encoding="utf-8"?>\n<response>%s</response>' % value).encode()
+        parts = ['\n<?xml version="1.0" encoding="utf-8"?>\n<response list="true">\n']
+        for item in value:
+            if isinstance(item, int):
+                parts.append(" <count>%d</count>\n" % item)
+            else:
+                parts.append(" <audio>\n%s </audio>\n" % "".join(
+                    "  <%s>%s</%s>\n" % (k, escape(escape(str(v))), k) for k, v in item.items()))
+        parts.append("</response>\n")
+        return "text/xml", "".join(parts).encode("utf-8")
+
+    def error(self, xml, error):
+        if not xml:
+            return "application/json", json.dumps({"error": error}).encode("utf-8")
+        return "text/xml", ('<?xml version="1.0" encoding="utf-8"?>\n<error>%s</error>' % "".join(
+            "<%s>%s</%s>" % (k, escape(str(v)), k) for k, v in error.items())).encode("utf-8")
+
+
+class FakeVKHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are written apart: on a kept-alive connection, Nagle would hold
+    # the body back till the client acks the headers, a delayed ack later
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(parts.query))
+        if parts.path == "/captcha.php":
+            method = "captcha"
+        else:
+            method = parts.path[len("/method/"):]
+        content_type, body = self.server.vk.answer(method, params)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+# The fake api behind TLS, with a self-signed certificate for 127.0.0.1 made by the openssl command.
+# The handshakes are made in the threads of the requests, and counted
+class FakeVKTLS(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, vk, directory):
+        http.server.ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), FakeVKHandler)
+        self.vk = vk
+        self.handshakes = 0
+        self.lock = threading.Lock()
+        self.certfile = os.path.join(directory, "cert.pem")
+        keyfile = os.path.join(directory, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                        "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+                        "-keyout", keyfile, "-out", self.certfile], check=True, capture_output=True)
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(self.certfile, keyfile)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def finish_request(self, request, client_address):
+        request = self.context.wrap_socket(request, server_side=True)
+        with self.lock:
+            self.handshakes += 1
+        http.server.ThreadingHTTPServer.finish_request(self, request, client_address)
+
+    def shutdown(self):
+        http.server.ThreadingHTTPServer.shutdown(self)
+        self.server_close()
+
+
+# GLib's main loop: the idle and timeout callbacks wait in a queue, pumped by run_until()
+class MainLoop:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.removed = set()
+        self.ids = iter(range(1, sys.maxsize))
+
+    def idle_add(self, func, *args):
+        source = next(self.ids)
+        self.queue.put((0, 0, source, func, args))
+        return source
+
+    def timeout_add(self, interval, func, *args):
+        source = next(self.ids)
+        self.queue.put((time.monotonic() + interval / 1000.0, interval / 1000.0, source, func, args))
+        return source
+
+    def source_remove(self, source):
+        self.removed.add(source)
+
+    # drops everything waiting, e.g. what an earlier test left behind
+    def clear(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def run_until(self, done, timeout=300):
+        deadline = time.monotonic() + timeout
+        while not done():
+            if time.monotonic() > deadline:
+                raise RuntimeError("timed out")
+            try:
+                when, interval, source, func, args = self.queue.get(timeout=0.01)
+            except queue.Empty:
+                continue
+            if source in self.removed:
+                continue
+            now = time.monotonic()
+            if when > now:
+                empty = self.queue.empty()
+                self.queue.put((when, interval, source, func, args))
+                if empty:
+                    time.sleep(min(0.005, when - now))
+                continue
+            if func(*args):
+                self.queue.put((time.monotonic() + interval, interval, source, func, args))
+
+
+# anything not defined does nothing and returns a stub
+class Stub:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return Stub()
+
+    def __call__(self, *args, **kwargs):
+        return Stub()
+
+    def __iter__(self):
+        return iter([])
+
+    def get_children(self):
+        return [Stub(), Stub(), Stub()]
+
+
+class Entry(Stub):
+    def __init__(self, *args, **kwargs):
+        self.text = ""
+
+    def set_text(self, text):
+        self.text = text
+
+    def get_text(self):
+        return self.text
+
+
+class CheckButton(Stub):
+    active = False
+
+    @staticmethod
+    def new_with_label(label):
+        return CheckButton()
+
+    def set_active(self, active):
+        self.active = active
+
+    def get_active(self):
+        return self.active
+
+
+class Settings:
+    # the defaults come from the plugin's schema
+    def __init__(self, overrides):
+        self.values = {}
+        schema = ElementTree.parse(os.path.join(ROOT, "org.gnome.rhythmbox.plugins.vk.gschema.xml"))
+        for key in schema.iter("key"):
+            default = key.findtext("default")
+            kind = key.get("type")
+            if kind == "s":
+                value = default.strip('"')
+            elif kind == "b":
+                value = default == "true"
+            else:
+                value = int(default)
+            self.values[key.get("name")] = value
+        self.values.update(overrides)
+
+    def get_string(self, key):
+        return self.values[key]
+
+    get_int = get_int64 = get_boolean = get_string
+
+    def set_string(self, key, value):
+        self.values[key] = value
+
+    set_int = set_int64 = set_boolean = set_string
+
+    def connect(self, signal, handler):
+        return 0
+
+
+class DBEntry:
+    def __init__(self, entry_type, location):
+        self.entry_type = entry_type
+        self.values = {"location": location}
+
+    def get_string(self, prop):
+        return self.values.get(prop)
+
+    def get_entry_type(self):
+        return self.entry_type
+
+
+# what the playlist manager creates for the imported tracklists
+class Playlist:
+    def __init__(self, name):
+        self.name = name
+        self.locations = []
+
+    def add_location(self, location, index):
+        self.locations.append(location)
+
+
+# RhythmDB, counting the calls
+class RhythmDB:
+    def __init__(self):
+        self.entries = {}
+        self.calls = collections.Counter()
+
+    def entry_lookup_by_location(self, location):
+        self.calls["lookup"] += 1
+        return self.entries.get(location)
+
+    def entry_new(self, entry_type, location):
+        self.calls["new"] += 1
+        entry = self.entries[location] = DBEntry(entry_type, location)
+        return entry
+
+    def entry_set(self, entry, prop, value):
+        self.calls["set"] += 1
+        if prop == "location":
+            self.entries[value] = self.entries.pop(entry.values["location"])
+        entry.values[prop] = value
+
+    def entry_delete(self, entry):
+        self.calls["delete"] += 1
+        self.entries.pop(entry.values["location"], None)
+
+    def entry_delete_by_type(self, entry_type):
+        self.entries.clear()
+
+    def entry_foreach_by_type(self, entry_type, func, data):
+        for entry in list(self.entries.values()):
+            func(entry, data)
+
+    def commit(self):
+        self.calls["commit"] += 1
+
+
+def install_gi_stubs(loop, cache_dir):
+    repository = types.ModuleType("gi.repository")
+
+    def module(name, **attrs):
+        m = types.ModuleType(name)
+        m.__dict__.update(attrs)
+        m.__getattr__ = lambda attr: Stub()
+        setattr(repository, name, m)
+        return m
+
+    # not a Stub, a misspelled attribute of the source has to fail here as it would in rhythmbox
+    class BrowserSource:
+        def __init__(self, kwargs):
+            self.props = types.SimpleNamespace(
+                shell=kwargs["shell"], entry_type=kwargs["entry_type"], query_model=Stub())
+
+        def get_children(self):
+            return [Stub()]
+
+    prop = types.SimpleNamespace(TITLE="title", ARTIST="artist", DURATION="duration", ALBUM="album",
+                                 LOCATION="location")
+    module("RB", RhythmDBEntryType=type("RhythmDBEntryType", (), {"__init__": lambda self, **kw: None}),
+           BrowserSource=BrowserSource, Source=Stub(), RhythmDBPropType=prop, locale_dir=lambda: None,
+           RhythmDBEntry=types.SimpleNamespace(new=lambda db, entry_type, location: db.entry_new(entry_type,
+                                                                                                  location)))
+    module("GObject", Object=type("Object", (), {}), GObject=object, property=lambda **kw: None,
+           type_register=lambda cls: None)
+    module("Peas", Activatable=type("Activatable", (), {}))
+    module("PeasGtk", Configurable=type("Configurable", (), {}))
+    module("Gtk", Entry=Entry, CheckButton=CheckButton, get_current_event_state=lambda: (False, 0))
+    module("Gdk", ModifierType=types.SimpleNamespace(SHIFT_MASK=1))
+    module("GdkPixbuf")
+    module("Gio")
+    module("GLib", idle_add=loop.idle_add, timeout_add=loop.timeout_add, source_remove=loop.source_remove,
+           get_user_cache_dir=lambda: cache_dir)
+    gi = types.ModuleType("gi")
+    gi.repository = repository
+    sys.modules["gi"] = gi
+    sys.modules["gi.repository"] = repository
+
+
+# the player, telling what is playing and what it was asked to play
+class Player:
+    def __init__(self):
+        self.playing = None
+        self.elapsed = 0
+        self.played = []
+
+    def get_playing_entry(self):
+        return self.playing
+
+    def get_playing_time(self):
+        return self.playing is not None, self.elapsed
+
+    def play_entry(self, entry, source):
+        self.played.append(entry)
+
+    def connect(self, signal, handler):
+        return 0
+
+    def disconnect(self, handler):
+        return
+
+
+def load_vk(loop, cache_dir, port):
+    install_gi_stubs(loop, cache_dir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    sys.modules.pop("vk", None)
+    import vk
+    # the captcha is answered right away
+    vk.captcha_dialog = lambda data: "bench"
+    # kept for the clients which really go to the host of the url
+    vk.VKHttpClient.direct_connection = vk.VKHttpClient.connection
+
+    # every host is the fake server, the connections are still pooled by the client.
+    # Another fake server can be swapped in by changing fake_port
+    def connection(client, scheme, host):
+        with client.lock:
+            idle = client.pool.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+            client.connections += 1
+        return http.client.HTTPConnection("127.0.0.1", client.fake_port, timeout=client.timeout), False
+
+    vk.VKHttpClient.connection = connection
+    vk.VKHttpClient.fake_port = port
+    return vk
+
+
+# A fresh source, as after activating the plugin, with the token checked already (as it mostly is).
+# The stats go to a file, not the console.
+def new_source(vk, cache_dir, **overrides):
+    shell = types.SimpleNamespace(props=types.SimpleNamespace(
+        shell_player=Player(), db=None,
+        queue_source=types.SimpleNamespace(props=types.SimpleNamespace(query_model=[])),
+        playlist_manager=types.SimpleNamespace(new_playlist=lambda name, automatic: Playlist(name))))
+    source = vk.VKSource(shell=shell, entry_type="vk-entry-type")
+    db = shell.props.db = RhythmDB()
+    values = {"token": "bench-token", "token-checked": hashlib.sha1(b"bench-token").hexdigest(),
+              "token-checked-time": int(time.time()), "stats-file": os.path.join(cache_dir, "stats.jsonl")}
+    values.update(overrides)
+    source.setup(db, Settings(values))
+    source.do_selected()
+    return source, db
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.loop = MainLoop()
+        self.cache_dir = tempfile.mkdtemp(prefix="vk-bench-")
+        self.fake = FakeVK(args.catalogue, args.latency / 1000.0, args.captcha_every)
+        self.vk = load_vk(self.loop, self.cache_dir, self.fake.server.server_port)
+
+    def close(self):
+        self.fake.shutdown()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def source(self, cache):
+        return new_source(self.vk, self.cache_dir, **{"amount": self.args.amount, "api-format": self.args.api_format,
+                                                      "cache-ttl": 3600 if cache else 0, "max-entries": 1000000})
+
+    # amount lines of the catalogue written the way people do, and a few tracks vk doesn't have
+    def tracklist(self):
+        filename = os.path.join(self.cache_dir, "tracklist.txt")
+        with open(filename, "w") as f:
+            for n, i in enumerate(range(0, self.args.catalogue, max(1, self.args.catalogue // self.args.amount))):
+                if n == self.args.amount:
+                    break
+                track = self.fake.track(i)
+                if n % 20 == 19:
+                    f.write("Nobody - Nothing %d\n" % n)
+                else:
+                    f.write("%d. %s – %s (live)\n" % (n + 1, track["artist"], track["title"].replace("&", "and")))
+        return filename
+
+    def run_search(self, source, button, query):
+        done = len(source.get_search_stats())
+        started = time.perf_counter()
+        if button == "import":
+            source.import_tracklist(query)
+        else:
+            handler = source.search_button_clicked if button == "search" else source.audios_button_clicked
+            handler(None, lambda: query, lambda: False, lambda: str(self.args.amount))
+        self.loop.run_until(lambda: len(source.get_search_stats()) > done)
+        return time.perf_counter() - started, source.get_search_stats()[-1]
+
+    # runs a search repeat times (plus once more for the memory), returns the medians
+    def scenario(self, name, button, query, warm=False):
+        if button == "decode":
+            return self.decode(name)
+        if button == "xml-parse":
+            return self.xml_parse(name)
+        if button == "tls":
+            return self.tls(name)
+        if button == "entries":
+            return self.entries(name)
+        if button == "import":
+            query = self.tracklist()
+        runs = []
+        for i in range(self.args.repeat):
+            source, db = self.source(cache=warm)
+            if warm:
+                self.run_search(source, button, query)
+                source.clear_button_clicked(None)
+            requests = sum(self.fake.requests.values())
+            elapsed, stats = self.run_search(source, button, query)
+            runs.append({"latency": elapsed, "first_result": stats["first_result"] or elapsed,
+                         "inserted": len(db.entries), "commits": db.calls["commit"],
+                         "requests": sum(self.fake.requests.values()) - requests,
+                         "connections": source.http.connections, "times": stats["times"]})
+        source, db = self.source(cache=warm)
+        if warm:
+            self.run_search(source, button, query)
+            source.clear_button_clicked(None)
+        tracemalloc.start()
+        self.run_search(source, button, query)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        def median(values):
+            return sorted(values)[len(values) // 2]
+
+        latency = median([run["latency"] for run in runs])
+        inserted = median([run["inserted"] for run in runs])
+        return {
+            "scenario": name,
+            "search_latency_ms": round(latency * 1000, 1),
+            "first_result_ms": round(median([run["first_result"] for run in runs]) * 1000, 1),
+            "tracks_inserted": inserted,
+            "tracks_per_second": round(inserted / latency, 1) if latency else None,
+            "db_commits": median([run["commits"] for run in runs]),
+            "requests": median([run["requests"] for run in runs]),
+            "connections": median([run["connections"] for run in runs]),
+            "peak_memory_kb": round(peak / 1024.0, 1),
+            "stages_ms": {stage: round(median([run["times"].get(stage, 0) for run in runs]) * 1000, 1)
+                          for stage in sorted(set(s for run in runs for s in run["times"]))},
+        }
+
+    # The same answer of amount tracks, recorded from the fake api in both formats, read the way a search
+    # reads it: how long the decoding takes, and how much memory the decoded tracks hold
+    def decode(self, name):
+        result = {"scenario": name}
+        for api_format in ("xml", "json"):
+            method = "audio.search.xml" if api_format == "xml" else "audio.search"
+            # an answered captcha, --captcha-every is about the searches
+            content_type, body = self.fake.answer(method, {"q": "artist", "count": str(self.args.amount),
+                                                           "captcha_key": "bench"})
+            times = []
+            for i in range(self.args.repeat):
+                started = time.perf_counter()
+                self.read(api_format, body)
+                times.append(time.perf_counter() - started)
+            tracemalloc.start()
+            tracks = self.read(api_format, body)
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            result[api_format + "_response_kb"] = round(len(body) / 1024.0, 1)
+            result[api_format + "_decode_ms"] = round(sorted(times)[len(times) // 2] * 1000, 1)
+            result[api_format + "_bytes_per_track"] = round(memory / float(len(tracks)), 1)
+        return result
+
+    def read(self, api_format, body):
+        reader = self.vk.VKXMLReader() if api_format == "xml" else self.vk.VKJSONReader()
+        tracks = []
+        for offset in range(0, len(body), 16384):
+            tracks.extend(reader.feed(body[offset:offset + 16384]))
+        reader.close()
+        return tracks
+
+    # xml answers of 100, 1000 and 6000 tracks (the most audio.get returns), read by the streaming
+    # reader and the way the plugin used to: a minidom tree of the whole body, searched by tag name
+    def xml_parse(self, name):
+        result = {"scenario": name}
+        for count in (100, 1000, 6000):
+            content_type, body = self.fake.answer("audio.search.xml", {"q": "artist", "count": str(count),
+                                                                       "captcha_key": "bench"})
+            for parser, read in (("minidom", read_minidom), ("stream", lambda body: self.read("xml", body))):
+                times = []
+                for i in range(self.args.repeat):
+                    started = time.perf_counter()
+                    read(body)
+                    times.append(time.perf_counter() - started)
+                tracemalloc.start()
+                tracks = read(body)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                assert len(tracks) == min(count, self.args.catalogue)
+                result["%s_%d_ms" % (parser, count)] = round(sorted(times)[len(times) // 2] * 1000, 1)
+                result["%s_%d_peak_kb" % (parser, count)] = round(peak / 1024.0, 1)
+        return result
+
+    # amount / 10 searches one after the other over https, through the client's own HTTPSConnection:
+    # a new connection (and TLS handshake) for every request, as before the pool, against the pooled client
+    def tls(self, name):
+        if shutil.which("openssl") is None:
+            return {"scenario": name, "skipped": "no openssl command"}
+        server = FakeVKTLS(self.fake, self.cache_dir)
+        create_context = ssl._create_default_https_context
+        # the certificate is checked, against the self-signed one
+        ssl._create_default_https_context = lambda: ssl.create_default_context(cafile=server.certfile)
+        url = "https://127.0.0.1:%d/method/audio.search?q=artist&count=100&captcha_key=bench" % server.server_port
+        result = {"scenario": name}
+        try:
+            for mode, pool_size in (("fresh", 0), ("pooled", 4)):
+                client = self.vk.VKHttpClient(pool_size=pool_size)
+                client.connection = types.MethodType(self.vk.VKHttpClient.direct_connection, client)
+                handshakes = server.handshakes
+                times = []
+                handshake_times = []
+                for i in range(max(1, self.args.amount // 10)):
+                    started = time.perf_counter()
+                    response = client.get(url)
+                    response.read()
+                    response.close()
+                    times.append(time.perf_counter() - started)
+                    if response.timings[0]:
+                        handshake_times.append(response.timings[0])
+                result[mode + "_handshakes"] = server.handshakes - handshakes
+                result[mode + "_request_ms"] = round(sorted(times)[len(times) // 2] * 1000, 1)
+                result[mode + "_handshake_ms"] = round(sum(handshake_times) * 1000 / len(times), 1)
+        finally:
+            ssl._create_default_https_context = create_context
+            server.shutdown()
+        return result
+
+    # ENTRIES_SEARCHES searches of amount * 3 tracks each, every one finding again a sixth of the previous
+    # one's tracks, inserted chunk by chunk the way the answers are: how long a chunk takes to dedup and
+    # insert, as the index grows past 10000 entries
+    ENTRIES_SEARCHES = 5
+
+    def entries(self, name):
+        source, db = self.source(cache=False)
+        count = self.args.amount * 3
+        step = count - count // 6
+        chunks = []
+        for n in range(self.ENTRIES_SEARCHES):
+            search = self.vk.VkontakteSearch("entries %d" % n, "0", str(count), db, "vk-entry-type", None,
+                                             source.TOKEN, chunk_size=source.INSERT_CHUNK, tracks=source.tracks,
+                                             index=source.index)
+            search.stats = self.vk.VKSearchStats("audio.search", search.search_line, count)
+            search.on_inserted = source.trim_entries
+            search.pending.extend(self.vk.JSONResult(self.fake.track(i)) for i in range(n * step, n * step + count))
+            more = True
+            while more:
+                dedup = search.stats.times["dedup"]
+                started = time.perf_counter()
+                more = search.insert_chunk()
+                chunks.append((n, time.perf_counter() - started, search.stats.times["dedup"] - dedup))
+
+        def median(values):
+            return sorted(values)[len(values) // 2]
+
+        return {
+            "scenario": name,
+            "entries": len(db.entries),
+            "duplicates": self.ENTRIES_SEARCHES * count - len(db.entries),
+            "chunks": len(chunks),
+            "chunk_ms": round(median([chunk[1] for chunk in chunks]) * 1000, 2),
+            "first_chunk_ms": round(median([chunk[1] for chunk in chunks if chunk[0] == 0]) * 1000, 2),
+            "last_chunk_ms": round(median([chunk[1] for chunk in chunks
+                                           if chunk[0] == self.ENTRIES_SEARCHES - 1]) * 1000, 2),
+            "dedup_ms": round(median([chunk[2] for chunk in chunks]) * 1000, 2),
+        }
+
+
+# the tracks of an xml answer, as the plugin read them before the streaming reader
+class MinidomResult:
+    def __init__(self, entry):
+        try:
+            self.title = entry.getElementsByTagName('title')[0].firstChild.nodeValue.strip()
+            self.duration = int(entry.getElementsByTagName('duration')[0].firstChild.nodeValue)
+            self.artist = entry.getElementsByTagName('artist')[0].firstChild.nodeValue.strip()
+            self.url = entry.getElementsByTagName('url')[0].firstChild.nodeValue
+        except:
+            self.url = None
+
+
+def read_minidom(body):
+    xmldoc = minidom.parseString(body.lstrip())
+    return [MinidomResult(audio) for audio in xmldoc.getElementsByTagName("audio")]
+
+
+SCENARIOS = {
+    # (button, query, warm cache)
+    "search": ("search", "artist", False),
+    "search-cached": ("search", "artist", True),
+    "audios": ("audios", "", False),
+    # resolving a tracklist of amount lines into a playlist
+    "import": ("import", None, False),
+    # decoding an answer of amount tracks, xml against json
+    "decode": ("decode", None, False),
+    # the streaming xml reader against the old minidom parsing, on answers of 100/1000/6000 tracks
+    "xml-parse": ("xml-parse", None, False),
+    # amount / 10 requests over https, a connection for each one against the pooled client
+    "tls": ("tls", None, False),
+    # 10000+ entries from several overlapping searches, the time to dedup and insert a chunk
+    "entries": ("entries", None, False),
+}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_result(filename, result):
+    previous = None
+    try:
+        with open(filename) as f:
+            for line in f:
+                record = json.loads(line)
+                if record["scenario"] == result["scenario"] and record["params"] == result["params"]:
+                    previous = record
+    except (OSError, ValueError):
+        pass
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmarks of the vk plugin against a fake vk api")
+    parser.add_argument("scenarios", nargs="*", choices=sorted(SCENARIOS) + [[]], default=[],
+                        help="scenarios to run (default: all)")
+    parser.add_argument("--amount", type=int, default=1000, help="tracks asked for (default: 1000)")
+    parser.add_argument("--catalogue", type=int, default=10000, help="tracks known by the fake api (default: 10000)")
+    parser.add_argument("--latency", type=float, default=30, help="fake api latency in ms (default: 30)")
+    parser.add_argument("--captcha-every", type=int, default=0,
+                        help="answer every Nth request with a captcha error (default: never)")
+    parser.add_argument("--api-format", choices=("json", "xml"), default="json",
+                        help="format of the api answers the searches ask for (default: json)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per scenario, the median is kept (default: 3)")
+    parser.add_argument("--results", default=os.path.join(ROOT, "bench", "results.jsonl"),
+                        help="JSON lines file the results are appended to")
+    args = parser.parse_args()
+    params = {"amount": args.amount, "catalogue": args.catalogue, "latency": args.latency,
+              "captcha_every": args.captcha_every, "api_format": args.api_format}
+
+    bench = Bench(args)
+    try:
+        for name in args.scenarios or sorted(SCENARIOS):
+            result = bench.scenario(name, *SCENARIOS[name])
+            result.update({"time": time.time(), "revision": git_revision(), "params": params})
+            previous = previous_result(args.results, result)
+            print("%s:" % name)
+            for key, value in result.items():
+                if key in ("scenario", "stages_ms", "time", "revision", "params"):
+                    continue
+                line = "  %-20s %10s" % (key, value)
+                if previous is not None and previous.get(key) and result[key] is not None:
+                    line += "   (%+.1f%% vs %s)" % ((result[key] - previous[key]) * 100.0 / previous[key],
+                                                   previous["revision"])
+                print(line)
+            if "stages_ms" in result:
+                print("  stages (ms)          %s" % " ".join("%s=%s" % item for item in result["stages_ms"].items()))
+            with open(args.results, "a") as f:
+                f.write(json.dumps(result) + "\n")
+    finally:
+        bench.close()
+
+
+if __name__ == "__main__":
+    main()
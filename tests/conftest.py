@@ -0,0 +1,49 @@
+# -*- coding: utf8 -*-
+# The tests run the plugin the way bench/vk_bench.py does: the gi modules and RhythmDB are stubs,
+# GLib's main loop is pumped by the test and vk is a local fake api.
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+import vk_bench  # noqa: E402
+
+LOOP = vk_bench.MainLoop()
+VK = vk_bench.load_vk(LOOP, None, 0)
+
+
+@pytest.fixture
+def vk(tmp_path, monkeypatch):
+    # every test gets its own caches
+    monkeypatch.setattr(VK.GLib, "get_user_cache_dir", lambda: str(tmp_path))
+    return VK
+
+
+@pytest.fixture
+def loop():
+    LOOP.clear()
+    return LOOP
+
+
+@pytest.fixture
+def fake(vk):
+    fake = vk_bench.FakeVK(1000, 0, 0)
+    vk.VKHttpClient.fake_port = fake.server.server_port
+    yield fake
+    fake.shutdown()
+
+
+# new_source(**settings) gives a (source, db) as after activating the plugin
+@pytest.fixture
+def new_source(vk, loop, tmp_path):
+    sources = []
+
+    def new_source(**settings):
+        source, db = vk_bench.new_source(vk, str(tmp_path), **settings)
+        sources.append(source)
+        return source, db
+
+    yield new_source
+    for source in sources:
+        source.do_impl_delete_thyself()
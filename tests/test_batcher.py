@@ -0,0 +1,73 @@
+# -*- coding: utf8 -*-
+# VKBatcher against the fake api of the benchmark, which runs the calls of execute one by one.
+import pytest
+
+
+@pytest.fixture
+def batcher(vk, fake):
+    return vk.VKBatcher(vk.VKScheduler(vk.VKHttpClient(), rate=100, burst=100))
+
+
+def by_id(i):
+    return [("audios", "%d_%d" % (1000 + i % 7, i + 1))]
+
+
+def test_one_call_goes_alone(batcher, fake):
+    assert batcher.call("token", "audio.getById", by_id(5))[0]["aid"] == 6
+    assert fake.requests == {"audio.getById": 1}
+
+
+def test_calls_are_batched_by_25(batcher, fake):
+    calls = [batcher.submit("token", "audio.getById", by_id(i)) for i in range(60)]
+    assert [call.result()[0]["aid"] for call in calls] == list(range(1, 61))
+    assert fake.requests == {"execute": 3}
+    assert (batcher.calls, batcher.batches) == (60, 3)
+
+
+def test_failed_calls_dont_fail_the_batch(vk, batcher, fake):
+    good = batcher.submit("token", "audio.getById", by_id(1))
+    bad = batcher.submit("token", "audio.nothing", [])
+    assert good.result()[0]["aid"] == 2
+    with pytest.raises(vk.VKApiError) as error:
+        bad.result()
+    assert error.value.err_code == 3
+    assert fake.requests == {"execute": 1}
+
+
+def test_batches_go_with_their_most_urgent_call(vk, batcher, monkeypatch):
+    scheduler = batcher.api
+    acquired = []
+    acquire = scheduler.acquire
+
+    def record(priority):
+        acquired.append(priority)
+        acquire(priority)
+
+    monkeypatch.setattr(scheduler, "acquire", record)
+    # urls of the next tracks with the one being played
+    background = batcher.submit("token", "audio.getById", by_id(1), scheduler.BACKGROUND)
+    playing = batcher.submit("token", "audio.getById", by_id(2), scheduler.PLAYING)
+    playing.result()
+    background.result()
+    assert acquired == [scheduler.PLAYING]
+    # alone, the background calls wait for everything else
+    batcher.call("token", "audio.getById", by_id(3), scheduler.BACKGROUND)
+    assert acquired == [scheduler.PLAYING, scheduler.BACKGROUND]
+
+
+def test_request_params_go_on_the_request(vk, batcher, fake):
+    fake.captcha_needed = True
+    with pytest.raises(vk.VKApiError) as error:
+        batcher.call("token", "audio.getById", by_id(1))
+    assert error.value.err_code == 14
+    captcha = [("captcha_sid", error.value.captcha_sid), ("captcha_key", "answer")]
+    calls = [batcher.submit("token", "audio.getById", by_id(i), request_params=captcha) for i in (2, 3)]
+    assert [call.result()[0]["aid"] for call in calls] == [3, 4]
+    assert fake.requests == {"audio.getById": 1, "execute": 1}
+
+
+def test_calls_with_other_request_params_go_apart(vk, batcher, fake):
+    calls = [batcher.submit("token", "audio.getById", by_id(1)),
+             batcher.submit("token", "audio.getById", by_id(2), request_params=[("captcha_key", "answer")])]
+    assert [call.result()[0]["aid"] for call in calls] == [2, 3]
+    assert fake.requests == {"audio.getById": 2}
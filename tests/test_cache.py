@@ -0,0 +1,71 @@
+# -*- coding: utf8 -*-
+import os
+import time
+
+
+def put(cache, query, data):
+    writer = cache.writer("token", "audio.search", [("q", query)])
+    writer.write(data)
+    writer.commit()
+    writer.close()
+
+
+def get(cache, query):
+    response = cache.open("token", "audio.search", [("q", query)])
+    if response is None:
+        return None
+    with response:
+        return response.read()
+
+
+def age(cache, query, seconds, accessed=None):
+    filename = cache.filename("token", "audio.search", [("q", query)])
+    now = time.time()
+    os.utime(filename, (accessed if accessed is not None else now, now - seconds))
+
+
+def test_hit_and_miss(vk, tmp_path):
+    cache = vk.VKCache(str(tmp_path), 3600, 1024 * 1024)
+    assert get(cache, "a") is None
+    put(cache, "a", b"<response/>")
+    assert get(cache, "a") == b"<response/>"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_responses_are_dropped(vk, tmp_path):
+    cache = vk.VKCache(str(tmp_path), 3600, 1024 * 1024)
+    put(cache, "fresh", b"1")
+    put(cache, "old", b"2")
+    age(cache, "fresh", 3500)
+    age(cache, "old", 3700)
+    assert get(cache, "fresh") == b"1"
+    assert get(cache, "old") is None
+    assert not os.path.exists(cache.filename("token", "audio.search", [("q", "old")]))
+
+
+def test_nothing_is_written_without_ttl(vk, tmp_path):
+    cache = vk.VKCache(str(tmp_path), 0, 1024 * 1024)
+    assert cache.writer("token", "audio.search", [("q", "a")]) is None
+
+
+def test_least_recently_used_are_evicted(vk, tmp_path):
+    cache = vk.VKCache(str(tmp_path), 3600, 2500)
+    now = time.time()
+    for n, query in enumerate(("a", "b")):
+        put(cache, query, b"x" * 1000)
+        age(cache, query, 10, accessed=now - 100 + n)
+    # a is older, but was read last
+    assert get(cache, "a") is not None
+    put(cache, "c", b"x" * 1000)
+    assert get(cache, "b") is None
+    assert get(cache, "a") is not None
+    assert get(cache, "c") is not None
+
+
+def test_unfinished_responses_are_not_cached(vk, tmp_path):
+    cache = vk.VKCache(str(tmp_path), 3600, 1024 * 1024)
+    writer = cache.writer("token", "audio.search", [("q", "a")])
+    writer.write(b"<respo")
+    writer.close()
+    assert get(cache, "a") is None
+    assert os.listdir(str(tmp_path)) == []
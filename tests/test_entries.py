@@ -0,0 +1,63 @@
+# -*- coding: utf8 -*-
+# The entries of the searches: duplicates are found by key or location, the least recently used go
+# once there are more than max-entries.
+
+
+def insert(vk, source, db, tracks):
+    search = vk.VkontakteSearch("q", "0", str(len(tracks)), db, "vk-entry-type", None, source.TOKEN,
+                                tracks=source.tracks, index=source.index)
+    search.on_inserted = source.trim_entries
+    search.pending.extend(vk.JSONResult(track) for track in tracks)
+    while search.insert_chunk():
+        pass
+    return search
+
+
+# the urls of the fake carry the time they were made at, so each track is made once
+def catalogue(fake, n):
+    return [fake.track(i) for i in range(n)]
+
+
+def titles(db):
+    return sorted(entry.get_string("title") for entry in db.entries.values())
+
+
+def test_duplicates_across_searches(vk, fake, new_source):
+    source, db = new_source()
+    tracks = catalogue(fake, 5)
+    a, b, c, d = tracks[1:]
+    first = insert(vk, source, db, [a, b, c])
+    # a with another url, and other spaces and case; b with other tags but the same url
+    second = insert(vk, source, db, [dict(a, url=a["url"] + "&copy", artist=" " + a["artist"].upper()),
+                                     dict(b, title="Another title"), d])
+    assert len(db.entries) == 4
+    assert titles(db) == ["Title %d & more" % i for i in (1, 2, 3, 4)]
+    assert second.locations - first.locations == {d["url"]}
+    assert len(source.index) == 4
+
+
+def test_deleted_entries_are_added_again(vk, fake, new_source):
+    source, db = new_source()
+    tracks = catalogue(fake, 3)
+    insert(vk, source, db, tracks[1:])
+    # the user deletes it, the index doesn't know
+    db.entry_delete(db.entries[tracks[1]["url"]])
+    insert(vk, source, db, [dict(tracks[1], url=tracks[1]["url"] + "&new")])
+    assert titles(db) == ["Title 1 & more", "Title 2 & more"]
+    assert tracks[1]["url"] + "&new" in db.entries
+    assert len(source.index) == 2
+
+
+def test_least_recently_used_entries_are_trimmed(vk, fake, new_source):
+    source, db = new_source(**{"max-entries": 5})
+    tracks = catalogue(fake, 8)
+    insert(vk, source, db, tracks[:5])
+    shell = source.props.shell.props
+    shell.shell_player.playing = db.entries[tracks[0]["url"]]
+    shell.queue_source.props.query_model.append([db.entries[tracks[1]["url"]]])
+    # found again, it is recent
+    insert(vk, source, db, [tracks[3]])
+    insert(vk, source, db, tracks[5:])
+    # the playing and the queued ones stay over the cap
+    assert titles(db) == sorted("Title %d & more" % i for i in (0, 1, 3, 4, 5, 6, 7))
+    assert len(source.index) == 7
@@ -0,0 +1,62 @@
+# -*- coding: utf8 -*-
+import http.server
+import threading
+import time
+
+import pytest
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        status = int(self.path.strip("/").split("/")[0])
+        body = b"body of %s" % self.path.encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+@pytest.fixture
+def server(vk):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.paths = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    vk.VKHttpClient.fake_port = server.server_port
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_connections_are_kept_alive(vk, server):
+    client = vk.VKHttpClient()
+    for n in range(4):
+        response = client.get("https://api.vk.com/200/%d" % n)
+        # a read without a size stops at the end of the body, the server doesn't close the connection
+        assert response.read() == b"body of /200/%d" % n
+        response.close()
+    assert (client.connections, client.requests) == (1, 4)
+
+
+def test_client_errors_are_not_retried(vk, server):
+    client = vk.VKHttpClient(backoff=0.01)
+    started = time.perf_counter()
+    with pytest.raises(vk.VKHttpError) as error:
+        client.get("https://cs1.vk.me/404/expired.mp3")
+    assert error.value.status == 404
+    assert server.paths == ["/404/expired.mp3"]
+    assert time.perf_counter() - started < 0.5
+
+
+def test_server_errors_are_retried(vk, server):
+    client = vk.VKHttpClient(retries=2, backoff=0.01)
+    with pytest.raises(vk.VKHttpError) as error:
+        client.get("https://api.vk.com/503/busy")
+    assert error.value.status == 503
+    assert len(server.paths) == 3
@@ -0,0 +1,79 @@
+# -*- coding: utf8 -*-
+
+
+def read(vk, tmp_path, name, text):
+    filename = tmp_path / name
+    filename.write_text(text, encoding="utf-8")
+    return vk.VKTracklistImport.read(str(filename))
+
+
+def test_text_lines(vk, tmp_path):
+    assert read(vk, tmp_path, "list.txt", "01. Artist – Title (live)\n\n# a comment\nJust a title\n") == [
+        ("Artist", "Title (live)", None), ("", "Just a title", None)]
+
+
+def test_m3u(vk, tmp_path):
+    text = "#EXTM3U\n#EXTINF:215,Artist - Title\n/music/a.mp3\n/music/Other%20Artist%20-%20Song.mp3\n"
+    assert read(vk, tmp_path, "list.m3u", text) == [("Artist", "Title", 215), ("Other Artist", "Song", None)]
+
+
+def test_csv_with_header(vk, tmp_path):
+    text = "Title,Artist,Duration\nSong,Someone,3:05\nNo artist,,\n"
+    assert read(vk, tmp_path, "list.csv", text) == [("Someone", "Song", 185), ("", "No artist", None)]
+
+
+def test_csv_without_header(vk, tmp_path):
+    assert read(vk, tmp_path, "list.csv", "Someone,Song,200\nArtist 2 - Title 2\n") == [
+        ("Someone", "Song", 200), ("Artist 2", "Title 2", None)]
+
+
+def tracklist(fake, tmp_path, tracks, missing=()):
+    filename = tmp_path / "My playlist.txt"
+    lines = ["%(artist)s - %(title)s" % fake.track(i) for i in tracks]
+    for n in missing:
+        lines.insert(n, "Nobody - Nothing at all")
+    filename.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return str(filename)
+
+
+def run_import(source, loop, filename):
+    source.import_tracklist(filename)
+    search = source.search
+    loop.run_until(lambda: source.search is None, timeout=30)
+    return search
+
+
+def test_tracks_are_resolved_in_order(vk, loop, fake, new_source, tmp_path):
+    source, db = new_source()
+    search = run_import(source, loop, tracklist(fake, tmp_path, [5, 700, 42, 13], missing=[2]))
+    assert search.playlist.name == "My playlist"
+    titles = [db.entries[location].get_string("title") for location in search.playlist.locations]
+    assert titles == ["Title %d & more" % i for i in (5, 700, 42, 13)]
+    assert search.missing == [("Nobody", "Nothing at all", None)]
+    # all the lines went in batches
+    assert fake.requests["audio.search"] == 0
+    assert fake.requests["execute"] >= 1
+
+
+def test_imported_entries_stay(vk, loop, fake, new_source, tmp_path):
+    source, db = new_source(**{"max-entries": 3})
+    search = run_import(source, loop, tracklist(fake, tmp_path, range(100, 108)))
+    imported = set(search.playlist.locations)
+    assert len(imported) == 8
+    source.search_button_clicked(None, lambda: "artist", lambda: False, lambda: "20")
+    loop.run_until(lambda: source.search is None, timeout=10)
+    # the searches are trimmed, the playlist is not
+    assert imported <= set(db.entries)
+    assert len(set(db.entries) - imported) <= 3
+    source.filter_entries("nothing like it")
+    assert set(db.entries) == imported
+
+
+def test_captcha_is_answered(vk, loop, fake, new_source, tmp_path):
+    source, db = new_source()
+    # vk wants a captcha before anything else
+    fake.captcha_needed = True
+    search = run_import(source, loop, tracklist(fake, tmp_path, [5, 700, 42]))
+    assert len(search.playlist.locations) == 3
+    assert fake.requests["captcha"] == 1
+    assert fake.requests["execute"] == 2
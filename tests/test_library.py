@@ -0,0 +1,50 @@
+# -*- coding: utf8 -*-
+import pytest
+
+
+@pytest.fixture
+def batcher(vk, fake):
+    return vk.VKBatcher(vk.VKScheduler(vk.VKHttpClient(), rate=100, burst=100))
+
+
+@pytest.fixture
+def library(vk, tmp_path):
+    return vk.VKLibrary(str(tmp_path / "library.db"), 3600)
+
+
+def count(library):
+    return library.db.execute("SELECT COUNT(*) FROM audio").fetchone()[0]
+
+
+def test_sync_is_incremental(library, batcher, fake):
+    assert library.sync(batcher, "token") == 1000
+    assert library.sync(batcher, "token") == 0
+    # the second sync only read the first page
+    assert fake.requests["audio.get"] == 2
+
+
+def test_full_sync_drops_removed_tracks(library, batcher, fake):
+    library.sync(batcher, "token")
+    # the oldest tracks are gone
+    fake.catalogue = 900
+    library.sync(batcher, "token")
+    assert count(library) == 1000
+    library.db.execute("UPDATE meta SET value = '0' WHERE key = 'full_sync'")
+    library.sync(batcher, "token")
+    assert count(library) == 900
+    assert library.search("title 950", 10) == []
+    assert len(library.search("title 850", 10)) == 1
+
+
+def test_copy_belongs_to_the_user(library, batcher, fake):
+    library.sync(batcher, "token")
+    # a new token of the same user
+    library.sync(batcher, "another token")
+    assert count(library) == 1000
+    assert fake.requests["users.get"] == 2
+    library.sync(batcher, "another token")
+    assert fake.requests["users.get"] == 2
+    fake.user_id = 2
+    fake.catalogue = 10
+    library.sync(batcher, "token of user 2")
+    assert count(library) == 10
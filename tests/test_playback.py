@@ -0,0 +1,207 @@
+# -*- coding: utf8 -*-
+import collections
+import http.client
+import http.server
+import os
+import threading
+import time
+
+import pytest
+
+
+def search(source, loop, query, amount):
+    source.search_button_clicked(None, lambda: query, lambda: False, lambda: str(amount))
+    loop.run_until(lambda: source.search is None, timeout=10)
+
+
+def get(playback, path, requested=None):
+    conn = http.client.HTTPConnection("127.0.0.1", playback.server.server_port, timeout=5)
+    try:
+        conn.request("GET", path, headers={"Range": requested} if requested else {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def get_range(playback, path, requested):
+    conn = http.client.HTTPConnection("127.0.0.1", playback.server.server_port, timeout=5)
+    try:
+        conn.request("GET", path, headers={"Range": requested})
+        response = conn.getresponse()
+        return response.status, response.getheader("Content-Range"), response.read()
+    finally:
+        conn.close()
+
+
+def track(path, size):
+    return (path.encode() * (size // len(path) + 1))[:size]
+
+
+# where the stream urls point to: every path is a track of origin.size bytes
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        origin = self.server
+        with origin.lock:
+            origin.requests[self.path] += 1
+            origin.ranges.append(self.headers.get("Range"))
+        data = track(self.path, origin.size)
+        requested = self.headers.get("Range", "")
+        if requested.startswith("bytes="):
+            start, sep, end = requested[6:].partition("-")
+            first = int(start) if start else len(data) - int(end)
+            last = int(end) if start and end else len(data) - 1
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (first, last, len(data)))
+            data = data[first:last + 1]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        return
+
+
+@pytest.fixture
+def origin():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), OriginHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = collections.Counter()
+    server.ranges = []
+    server.size = 10000
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def playback(vk, origin, tmp_path):
+    client = vk.VKHttpClient()
+    client.fake_port = origin.server_port
+    cache = vk.VKPlaybackCache(str(tmp_path / "tracks"), 25000, client)
+    yield cache
+    cache.shutdown()
+
+
+def settle(playback):
+    deadline = time.time() + 5
+    while playback.downloading and time.time() < deadline:
+        time.sleep(0.01)
+    assert not playback.downloading
+
+
+def cached(playback, track_id):
+    return os.path.exists(playback.track_file(track_id))
+
+
+def test_missing_tracks_pass_through_then_hit(playback, origin):
+    playback.location(1, 2, "http://cs1.vk.me/u1/2.mp3")
+    assert get(playback, "/1_2.mp3") == (200, track("/u1/2.mp3", 10000))
+    settle(playback)
+    assert cached(playback, "1_2")
+    # the player's request, and the download
+    assert origin.requests["/u1/2.mp3"] == 2
+    assert get(playback, "/1_2.mp3") == (200, track("/u1/2.mp3", 10000))
+    assert origin.requests["/u1/2.mp3"] == 2
+    assert (playback.hits, playback.misses) == (1, 1)
+
+
+def test_range_requests(playback, origin):
+    playback.location(1, 2, "http://cs1.vk.me/u1/2.mp3")
+    data = track("/u1/2.mp3", 10000)
+    # a malformed range gets the whole track, from vk as well
+    assert get(playback, "/1_2.mp3", "bytes=abc-") == (200, data)
+    settle(playback)
+    assert origin.ranges == [None, None]
+    assert get_range(playback, "/1_2.mp3", "bytes=100-199") == (206, "bytes 100-199/10000", data[100:200])
+    assert get_range(playback, "/1_2.mp3", "bytes=9990-") == (206, "bytes 9990-9999/10000", data[9990:])
+    assert get_range(playback, "/1_2.mp3", "bytes=-100") == (206, "bytes 9900-9999/10000", data[-100:])
+    assert get_range(playback, "/1_2.mp3", "bytes=-20000") == (206, "bytes 0-9999/10000", data)
+    assert get_range(playback, "/1_2.mp3", "bytes=10000-") == (416, "bytes */10000", b"")
+    assert get_range(playback, "/1_2.mp3", "bytes=-0") == (416, "bytes */10000", b"")
+    for requested in ("bytes=abc-", "bytes=5-2", "bytes=-", "items=1-2"):
+        assert get(playback, "/1_2.mp3", requested) == (200, data)
+
+
+def test_least_recently_played_tracks_are_evicted(playback, origin):
+    for aid in (1, 2, 3):
+        playback.location(1, aid, "http://cs1.vk.me/u1/%d.mp3" % aid)
+    playback.prefetch(["1_1", "1_2"])
+    settle(playback)
+    now = time.time()
+    os.utime(playback.track_file("1_1"), (now - 100, now))
+    os.utime(playback.track_file("1_2"), (now - 50, now))
+    # played again, the first one is the most recent now
+    get(playback, "/1_1.mp3")
+    playback.prefetch(["1_3"])
+    settle(playback)
+    assert [cached(playback, track_id) for track_id in ("1_1", "1_2", "1_3")] == [True, False, True]
+
+
+def test_tracks_bigger_than_the_cache_are_not_kept(playback, origin):
+    origin.size = 30000
+    playback.location(1, 2, "http://cs1.vk.me/u1/2.mp3")
+    for n in range(3):
+        assert get(playback, "/1_2.mp3") == (200, track("/u1/2.mp3", 30000))
+        settle(playback)
+    assert os.listdir(playback.directory) == []
+    # they are played from vk, the download was only tried once
+    assert origin.requests["/u1/2.mp3"] == 4
+
+
+def test_next_tracks_are_prefetched(vk, loop, fake, new_source, origin):
+    source, db = new_source(**{"playback-cache": True})
+    search(source, loop, "artist", 10)
+    entries = sorted(db.entries.values(), key=lambda entry: entry.get_string("title"))
+    shell = source.props.shell.props
+    # a full queue, the ones after it in the list are not looked at
+    shell.queue_source.props.query_model.extend([entry] for entry in entries[3:3 + source.REFRESH_AHEAD])
+    # the tracks are downloaded from the origin server
+    source.http.fake_port = origin.server_port
+    shell.shell_player.playing = entries[0]
+    source.playing_song_changed(shell.shell_player, entries[0])
+    settle(source.playback)
+    track_ids = [source.playback.track_id(entry.get_string("location")) for entry in entries]
+    assert [cached(source.playback, track_id) for track_id in track_ids] == [False] * 3 + [True] * 5 + [False] * 2
+
+
+def test_entries_play_through_the_proxy(vk, loop, fake, new_source):
+    source, db = new_source(**{"playback-cache": True})
+    search(source, loop, "artist", 10)
+    assert len(db.entries) == 10
+    assert all(source.playback.track_id(location) is not None for location in db.entries)
+
+
+def test_only_tracks_are_served(vk, loop, fake, new_source, tmp_path):
+    source, db = new_source(**{"playback-cache": True})
+    (tmp_path / "secret.mp3").write_bytes(b"not a track")
+    (tmp_path / "rhythmbox" / "vk-tracks" / "1_2.mp3").write_bytes(b"a track")
+    assert get(source.playback, "/1_2.mp3") == (200, b"a track")
+    for path in ("/../../secret.mp3", "/..%2F..%2Fsecret.mp3", "/1_2.ogg", "/1_2/../../../secret.mp3"):
+        status, body = get(source.playback, path)
+        assert status == 404
+        assert body != b"not a track"
+
+
+def test_turning_the_cache_off_stops_the_proxy(vk, loop, fake, new_source):
+    source, db = new_source(**{"playback-cache": True})
+    search(source, loop, "artist", 10)
+    playback = source.playback
+    port = playback.server.server_port
+    source.settings.set_boolean("playback-cache", False)
+    source.on_playback_cache_changed(source.settings, "playback-cache")
+    assert source.playback is None
+    # the entries play straight from vk again
+    assert len(db.entries) == 10
+    assert all(location.startswith("http://cs1.vk.me/") for location in db.entries)
+    assert set(source.tracks) == set(db.entries)
+    with pytest.raises(OSError):
+        http.client.HTTPConnection("127.0.0.1", port, timeout=1).connect()
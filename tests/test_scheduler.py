@@ -0,0 +1,186 @@
+# -*- coding: utf8 -*-
+# VKScheduler runs on a fake clock: waiting with a timeout moves the clock instead of sleeping.
+import io
+import threading
+
+import pytest
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+        self.cond = None
+        # the clock stops when frozen, waiting threads only wake up to look at it again
+        self.frozen = False
+
+    def __call__(self):
+        return self.now
+
+    def wait(self, timeout):
+        if timeout is None or self.frozen:
+            self.cond.wait(0.01)
+        else:
+            self.now += timeout
+
+
+class Response:
+    timings = (0, 0)
+
+    def __init__(self, body, gate=None, broken=False):
+        self.body = io.BytesIO(body)
+        self.gate = gate
+        self.broken = broken
+
+    def read(self, size=-1):
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.broken:
+            raise OSError("connection reset")
+        return self.body.read(size)
+
+    def close(self):
+        pass
+
+
+class HTTP:
+    def __init__(self):
+        self.urls = []
+        self.body = b'{"response": 1}'
+        self.gate = None
+        self.broken = False
+
+    def get(self, url, redirects=5, headers=None):
+        self.urls.append(url)
+        return Response(self.body, self.gate, self.broken)
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def scheduler(vk, clock):
+    scheduler = vk.VKScheduler(HTTP(), rate=3.0, burst=3, clock=clock, wait=clock.wait)
+    clock.cond = scheduler.cond
+    return scheduler
+
+
+def in_thread(func, *args):
+    result = {}
+
+    def run():
+        try:
+            result["value"] = func(*args)
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, result
+
+
+def wait_for(condition, timeout=5):
+    done = threading.Event()
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        done.wait(0.01)
+    raise AssertionError("timed out")
+
+
+def test_requests_are_paced(scheduler, clock):
+    sent = []
+    for _ in range(9):
+        scheduler.acquire(1)
+        sent.append(round(clock.now, 3))
+    # the burst goes at once, then three requests a second
+    assert sent == [0, 0, 0, 0.333, 0.667, 1.0, 1.333, 1.667, 2.0]
+
+
+def test_throttling_pauses_everything(scheduler, clock):
+    scheduler.throttled(2)
+    scheduler.acquire(1)
+    assert clock.now >= 4 / 3
+
+
+def test_urgent_requests_go_first(scheduler, clock):
+    clock.frozen = True
+    scheduler.tokens = 0
+    threads = {}
+    for priority in (scheduler.BACKGROUND, 2, 0):
+        threads[priority] = in_thread(scheduler.acquire, priority)[0]
+        wait_for(lambda: len(scheduler.waiting) == len(threads))
+    order = []
+    for _ in range(3):
+        sent = scheduler.sent
+        with scheduler.cond:
+            # one more token
+            clock.now += 1 / scheduler.rate
+            scheduler.cond.notify_all()
+        wait_for(lambda: scheduler.sent == sent + 1)
+        wait_for(lambda: sum(not thread.is_alive() for thread in threads.values()) == len(order) + 1)
+        order += [p for p, thread in threads.items() if not thread.is_alive() and p not in order]
+    assert order == [0, 2, scheduler.BACKGROUND]
+
+
+def test_same_calls_are_coalesced(scheduler):
+    scheduler.http.gate = threading.Event()
+    response = scheduler.get("audio.search", "https://api.vk.com/method/audio.search?q=a")
+    thread, result = in_thread(scheduler.get, "audio.search", "https://api.vk.com/method/audio.search?q=a")
+    wait_for(lambda: scheduler.coalesced == 1)
+    scheduler.http.gate.set()
+    try:
+        assert response.read() == b'{"response": 1}'
+    finally:
+        response.close()
+    thread.join(5)
+    assert result["value"].read() == b'{"response": 1}'
+    assert len(scheduler.http.urls) == 1
+    assert scheduler.inflight == {}
+
+
+def test_followers_redo_a_failed_call(scheduler):
+    scheduler.http.gate = threading.Event()
+    response = scheduler.get("audio.search", "https://api.vk.com/method/audio.search?q=a")
+    thread, result = in_thread(scheduler.get, "audio.search", "https://api.vk.com/method/audio.search?q=a")
+    wait_for(lambda: scheduler.coalesced == 1)
+    # the connection of the first caller breaks
+    response.response.broken = True
+    scheduler.http.gate.set()
+    with pytest.raises(OSError):
+        try:
+            response.read()
+        finally:
+            response.close()
+    thread.join(5)
+    # the follower sent the call again as the new first caller
+    try:
+        assert result["value"].read() == b'{"response": 1}'
+    finally:
+        result["value"].close()
+    assert len(scheduler.http.urls) == 2
+    assert scheduler.inflight == {}
+
+
+def test_followers_dont_wait_for_a_stuck_call(scheduler):
+    scheduler.FOLLOWER_TIMEOUT = 0.1
+    scheduler.http.gate = threading.Event()
+    stuck = scheduler.get("audio.search", "https://api.vk.com/method/audio.search?q=a")
+    scheduler.http.gate = None
+    thread, result = in_thread(scheduler.get, "audio.search", "https://api.vk.com/method/audio.search?q=a")
+    thread.join(5)
+    assert result["value"].read() == b'{"response": 1}'
+    assert len(scheduler.http.urls) == 2
+    stuck.close()
+    assert scheduler.inflight == {}
+
+
+def test_failed_batches_dont_leak_calls(vk, scheduler):
+    batcher = vk.VKBatcher(scheduler)
+    scheduler.http.broken = True
+    call = vk.VKBatchCall("audio.search", [("q", "a")], scheduler.SEARCH)
+    batcher.send("token", [call])
+    with pytest.raises(OSError):
+        call.result()
+    assert scheduler.inflight == {}
@@ -0,0 +1,180 @@
+# -*- coding: utf8 -*-
+import os
+import time
+
+
+def search(source, query, amount):
+    source.search_button_clicked(None, lambda: query, lambda: False, lambda: str(amount))
+
+
+def test_search_runs_in_the_background(vk, loop, fake, new_source):
+    fake.latency = 0.5
+    source, db = new_source()
+    started = time.perf_counter()
+    search(source, "artist", 100)
+    # the click returns without waiting for the slow server
+    assert time.perf_counter() - started < 0.2
+    ticks = []
+
+    def tick():
+        ticks.append(time.perf_counter())
+        return True
+
+    vk.GLib.timeout_add(20, tick)
+    loop.run_until(lambda: source.search is None, timeout=10)
+    assert len(db.entries) == 100
+    # the main loop kept running while the request was on its way
+    assert len(ticks) > 10
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.2
+
+
+def test_new_search_cancels_the_running_one(vk, loop, fake, new_source):
+    fake.latency = 0.3
+    source, db = new_source()
+    search(source, "artist", 100)
+    first = source.search
+    search(source, "title", 10)
+    assert first.cancelled.is_set()
+    loop.run_until(lambda: source.search is None, timeout=10)
+    time.sleep(0.5)
+    loop.run_until(lambda: loop.queue.empty(), timeout=10)
+    # nothing of the cancelled search reached the db
+    assert len(db.entries) == 10
+
+
+def type_text(source, text):
+    for n in range(1, len(text) + 1):
+        source.search_input.set_text(text[:n])
+        source.search_input_changed(source.search_input)
+
+
+def test_typing_searches_once(vk, loop, fake, new_source):
+    source, db = new_source(debounce=100)
+    source.search_fuzzy_checkbox.set_active(True)
+    type_text(source, "title 1")
+    loop.run_until(lambda: source.typing_timeout is None and source.search is None, timeout=10)
+    # only what was typed last is searched
+    assert fake.requests["audio.search"] == 1
+    assert db.entries
+    assert all("1" in entry.get_string("title") or "1" in entry.get_string("artist")
+               for entry in db.entries.values())
+
+
+def test_enter_while_typing_searches_once(vk, loop, fake, new_source):
+    source, db = new_source(debounce=100)
+    source.search_fuzzy_checkbox.set_active(True)
+    type_text(source, "title 1")
+    search(source, "title 1", 100)
+    first = source.search
+    assert source.typing_timeout is None
+    time.sleep(0.2)
+    loop.run_until(lambda: source.search is None, timeout=10)
+    assert not first.cancelled.is_set()
+    assert fake.requests["audio.search"] == 1
+
+
+def typed(source, loop, text):
+    source.search_input.set_text(text)
+    source.search_input_changed(source.search_input)
+    loop.run_until(lambda: source.typing_timeout is None and source.search is None, timeout=10)
+
+
+def test_complete_queries_are_reused_while_typing(vk, loop, fake, new_source):
+    source, db = new_source(debounce=10)
+    source.search_fuzzy_checkbox.set_active(True)
+    typed(source, loop, "title 1")
+    assert len(db.entries) == 2
+    # all there is for "title 1" is there already
+    typed(source, loop, "title 1 &")
+    assert fake.requests["audio.search"] == 1
+    assert len(db.entries) == 2
+    # found without autocomplete, the results may not be the same
+    search(source, "title 2", 100)
+    loop.run_until(lambda: source.search is None, timeout=10)
+    typed(source, loop, "title 2 &")
+    assert fake.requests["audio.search"] == 3
+
+
+def test_filtered_out_results_are_searched_again(vk, loop, fake, new_source):
+    source, db = new_source(debounce=10, **{"cache-ttl": 0})
+    source.search_fuzzy_checkbox.set_active(True)
+    typed(source, loop, "title 1")
+    typed(source, loop, "title 1 xyz")
+    assert fake.requests["audio.search"] == 1
+    assert not db.entries
+    # back to the shorter query, its results are gone
+    typed(source, loop, "title 1")
+    assert fake.requests["audio.search"] == 2
+    assert len(db.entries) == 2
+
+
+def test_trimmed_results_are_searched_again(vk, loop, fake, new_source):
+    source, db = new_source(debounce=10, **{"max-entries": 5})
+    source.search_fuzzy_checkbox.set_active(True)
+    typed(source, loop, "title 1")
+    search(source, "artist", 20)
+    loop.run_until(lambda: source.search is None, timeout=10)
+    typed(source, loop, "title 1 &")
+    assert fake.requests["audio.search"] == 3
+    assert len(db.entries) == 5
+
+
+def test_typing_keeps_the_playing_and_queued_entries(vk, loop, fake, new_source):
+    source, db = new_source()
+    search(source, "artist", 20)
+    loop.run_until(lambda: source.search is None, timeout=10)
+    entries = sorted(db.entries.values(), key=lambda entry: entry.get_string("title"))
+    playing, queued = entries[:2]
+    shell = source.props.shell.props
+    shell.shell_player.playing = playing
+    shell.queue_source.props.query_model.append([queued])
+    source.filter_entries("nothing like it")
+    assert set(db.entries.values()) == {playing, queued}
+
+
+def test_cache_hits_are_counted(vk, loop, fake, new_source):
+    source, db = new_source()
+    search(source, "artist", 500)
+    loop.run_until(lambda: source.search is None, timeout=10)
+    requests = sum(fake.requests.values())
+    assert "cache_hits" not in source.get_search_stats()[-1]["counts"]
+    source.clear_button_clicked(None)
+    search(source, "artist", 500)
+    loop.run_until(lambda: source.search is None, timeout=10)
+    # every page came from the cache
+    assert sum(fake.requests.values()) == requests
+    assert source.get_search_stats()[-1]["counts"]["cache_hits"] == len(os.listdir(source.cache.directory))
+
+
+def test_pages_cached_by_either_path_are_read_back(vk, loop, fake, new_source):
+    source, db = new_source()
+    # the batched pages meet a captcha and are fetched again one by one, which caches whole answers
+    fake.captcha_every = 2
+    search(source, "artist", 900)
+    loop.run_until(lambda: source.search is None, timeout=10)
+    assert len(db.entries) == 900
+    fake.captcha_every = 0
+    requests = sum(fake.requests.values())
+    source.clear_button_clicked(None)
+    search(source, "artist", 900)
+    loop.run_until(lambda: source.search is None, timeout=10)
+    assert len(db.entries) == 900
+    assert sum(fake.requests.values()) == requests
+
+
+def test_pages_are_merged_in_order(vk, loop, fake, new_source):
+    source, db = new_source()
+    search(source, "artist", 1000)
+    loop.run_until(lambda: source.search is None, timeout=10)
+    titles = [entry.get_string("title") for entry in db.entries.values()]
+    assert titles == ["Title %d & more" % i for i in range(1000)]
+    # the first page streamed, the other three went in one execute
+    assert fake.requests == {"audio.search": 1, "execute": 1}
+
+
+def test_pages_past_the_count_are_not_asked_for(vk, loop, fake, new_source):
+    source, db = new_source()
+    search(source, "title 1", 3000)
+    loop.run_until(lambda: source.search is None, timeout=10)
+    assert len(db.entries) == 2
+    assert fake.calls["audio.search"] == 1
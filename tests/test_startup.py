@@ -0,0 +1,53 @@
+# -*- coding: utf8 -*-
+# Loading and activating the plugin, in a fresh interpreter with the gi stubs of the benchmark.
+import json
+import os
+import subprocess
+import sys
+
+BENCH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench")
+
+# what only some features need, imported when they are first used
+LAZY = ["http.server", "difflib", "csv", "sqlite3"]
+
+SCRIPT = """
+import json, sys, threading, time
+sys.path.insert(0, %(bench)r)
+import vk_bench
+# the benchmark needs some of them itself
+for name in %(lazy)r:
+    sys.modules.pop(name, None)
+loop = vk_bench.MainLoop()
+started = time.perf_counter()
+vk = vk_bench.load_vk(loop, %(cache)r, 0)
+loaded = time.perf_counter()
+source, db = vk_bench.new_source(vk, %(cache)r)
+activated = time.perf_counter()
+print(json.dumps({"load": loaded - started, "setup": activated - loaded,
+                  "imported": [name for name in %(lazy)r if name in sys.modules],
+                  "requests": source.http.requests, "connections": source.http.connections,
+                  "threads": threading.active_count()}))
+"""
+
+
+def start(tmp_path):
+    script = SCRIPT % {"bench": BENCH, "lazy": LAZY, "cache": str(tmp_path)}
+    output = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_startup_is_quick(tmp_path):
+    started = start(tmp_path)
+    assert started["load"] < 0.5
+    assert started["setup"] < 0.5
+
+
+def test_startup_imports_only_what_it_needs(tmp_path):
+    assert start(tmp_path)["imported"] == []
+
+
+def test_startup_stays_off_the_network(tmp_path):
+    started = start(tmp_path)
+    assert (started["requests"], started["connections"]) == (0, 0)
+    # no token check or anything else in the background
+    assert started["threads"] == 1
@@ -0,0 +1,16 @@
+# -*- coding: utf8 -*-
+import hashlib
+
+
+def test_token_changed_while_checked(vk, loop, fake, new_source):
+    fake.latency = 0.3
+    source, db = new_source(token="old token", **{"token-checked": ""})
+    source.search_button_clicked(None, lambda: "title 1", lambda: False, lambda: "10")
+    assert fake.calls["users.isAppUser"] == 0
+    source.settings.set_string("token", "new token")
+    source.on_token_changed(source.settings, "token")
+    loop.run_until(lambda: len(db.entries) == 2, timeout=10)
+    # the answer about the old token didn't count, the new one was checked before searching
+    assert fake.calls["users.isAppUser"] == 2
+    assert source.configured
+    assert source.settings.get_string("token-checked") == hashlib.sha1(b"new token").hexdigest()
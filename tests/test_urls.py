@@ -0,0 +1,75 @@
+# -*- coding: utf8 -*-
+# The stream urls of the fake api expire, the ones of the entries are renewed when they start playing.
+import os
+import time
+
+
+def search(source, loop, query, amount):
+    source.search_button_clicked(None, lambda: query, lambda: False, lambda: str(amount))
+    loop.run_until(lambda: source.search is None, timeout=10)
+
+
+def age(source, seconds):
+    for location, (owner_id, aid, fetched) in list(source.tracks.items()):
+        source.tracks[location] = (owner_id, aid, fetched - seconds)
+
+
+def play(source, loop, entry, elapsed=0):
+    player = source.props.shell.props.shell_player
+    player.playing = entry
+    player.elapsed = elapsed
+    source.playing_song_changed(player, entry)
+    loop.run_until(lambda: not source.refreshing, timeout=10)
+
+
+def first(db):
+    return min(db.entries.values(), key=lambda entry: entry.get_string("title"))
+
+
+def test_old_urls_are_renewed(vk, loop, fake, new_source):
+    source, db = new_source(**{"url-ttl": 600})
+    search(source, loop, "title 1", 10)
+    play(source, loop, first(db))
+    # still fresh
+    assert fake.requests["audio.getById"] == 0
+    fake.url_lifetime = 900
+    age(source, 900)
+    entry = first(db)
+    old = entry.get_string("location")
+    play(source, loop, entry)
+    assert fake.requests["audio.getById"] == 1
+    assert entry.get_string("location") != old
+    assert not fake.expired(entry.get_string("location"))
+    assert source.tracks[entry.get_string("location")][2] > time.time() - 60
+
+
+def test_cached_answers_keep_their_age(vk, loop, fake, new_source):
+    source, db = new_source(**{"cache-ttl": 86400})
+    search(source, loop, "title 1", 10)
+    found = len(db.entries)
+    # the answer was cached two hours ago
+    directory = source.cache.directory
+    for name in os.listdir(directory):
+        os.utime(os.path.join(directory, name), (time.time(), time.time() - 7200))
+    source.clear_button_clicked(None)
+    search(source, loop, "title 1", 10)
+    assert fake.requests["audio.search"] == 1
+    assert len(db.entries) == found
+    assert all(fetched < time.time() - 7000 for owner_id, aid, fetched in source.tracks.values())
+    play(source, loop, first(db))
+    assert fake.requests["audio.getById"] == 1
+
+
+def test_playing_track_is_not_restarted(vk, loop, fake, new_source):
+    source, db = new_source()
+    player = source.props.shell.props.shell_player
+    search(source, loop, "title 1", 10)
+    age(source, 7200)
+    entries = sorted(db.entries.values(), key=lambda entry: entry.get_string("title"))
+    # the old url got it going already
+    play(source, loop, entries[0], elapsed=30)
+    assert fake.requests["audio.getById"] == 1
+    assert player.played == []
+    age(source, 7200)
+    play(source, loop, entries[-1])
+    assert player.played == [entries[-1]]
@@ -14,16 +14,102 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from gi.repository import RB, Gio, Gtk, GdkPixbuf, GObject, Peas, PeasGtk, WebKit2
-from xml.dom import minidom  # xml parser
+# Only what loading the plugin needs is imported here. WebKit2 (configure dialog), sqlite3 (library
+# copy), http.server (playback cache), csv and difflib (tracklist import) are imported when first used.
+from gi.repository import RB, Gio, Gtk, Gdk, GdkPixbuf, GObject, GLib, Peas, PeasGtk
+from xml.etree import ElementTree  # incremental xml parser
 from xml.sax.saxutils import unescape  # xml unescape
-import urllib.request, urllib.error, urllib.parse  # search line escaping, simple https requests
+import urllib.parse  # search line escaping
+import sys
+import os
+import time
+import hashlib
+import tempfile
+import zlib
+import io
+import heapq
+import itertools
+import json
+import http.client  # keep-alive connections to the api
+import shutil
+import threading  # searches are done in the background, off the GTK main loop
+import collections
+import queue
+import re
+import codecs
 
 import gettext
 
 gettext.install('rhythmbox', RB.locale_dir())
 
 
+# shows the captcha image and returns what the user typed, on the main loop
+def captcha_dialog(cp_data):
+    cp_image = Gtk.Image()
+    loader = GdkPixbuf.PixbufLoader.new_with_type('jpeg')
+    loader.write(cp_data)
+    loader.close()
+    cp_image.set_from_pixbuf(loader.get_pixbuf())
+    d = Gtk.Dialog(buttons=(Gtk.STOCK_OK, Gtk.ResponseType.OK))
+    cp_input = Gtk.Entry(width_chars=7, activates_default=True)
+    d.vbox.pack_start(cp_image, expand=False, fill=False, padding=0)
+    d.vbox.pack_start(cp_input, expand=False, fill=False, padding=0)
+    d.show_all()
+    d.run()
+    cp_text = cp_input.get_text()
+    d.destroy()
+    return cp_text
+
+
+# url of an api call. The json answers are the default, the xml ones are kept as a fallback
+def api_url(method, params, token, api_format="json"):
+    return "https://api.vk.com/method/%s%s?%s" % (method, ".xml" if api_format == "xml" else "",
+                                                  urllib.parse.urlencode(list(params) + [("access_token", token)]))
+
+
+# the "response" of a whole api answer, in either format. Errors raise VKApiError
+def api_response(body, api_format="json"):
+    if api_format == "xml":
+        # vkontakte sometimes returns invalid XML with empty first line
+        xml = ElementTree.fromstring(body.lstrip())
+        error = xml if xml.tag == "error" else xml.find("error")
+        if error is not None:
+            raise VKApiError(dict((child.tag, child.text) for child in error))
+        return xml.text
+    answer = json.loads(body.decode("utf-8"))
+    if "error" in answer:
+        raise VKApiError(answer["error"])
+    return answer["response"]
+
+
+# What a worker thread does about an api error, the same for every call. The flood control makes
+# the next requests wait, a captcha is shown on the main loop while the worker waits for the answer.
+# Returns the params to send the call again with ([] if there is nothing to add), or None to give up.
+def handle_api_error(api, error, attempt, cancelled=None):
+    if api.should_retry(error.err_code, attempt):
+        return []
+    if error.err_code == 14 and error.captcha_img:
+        cp_response = api.http.get(error.captcha_img)
+        try:
+            cp_data = cp_response.read()
+        finally:
+            cp_response.close()
+        answer = queue.Queue()
+
+        def ask():
+            # nobody cares about the captcha of a cancelled search
+            answer.put("" if cancelled is not None and cancelled.is_set() else captcha_dialog(cp_data))
+            return False
+
+        GLib.idle_add(ask)
+        cp_text = answer.get()
+        if len(cp_text) > 0:
+            return [("captcha_sid", error.captcha_sid), ("captcha_key", cp_text)]
+        return None
+    print(error)
+    return None
+
+
 # entry type for results. not saving on disk
 class VKEntryType(RB.RhythmDBEntryType):
     def __init__(self):
@@ -80,17 +166,26 @@ class VKRhythmbox(GObject.Object, Peas.Activatable):
 
 # Source is the tab, the "main window"
 class VKSource(RB.BrowserSource):
+    # a token which passed the check is trusted for a day
+    TOKEN_CHECK_TTL = 24 * 60 * 60
+    # how many of the next tracks get new urls along with the playing one
+    REFRESH_AHEAD = 5
+
     def __init__(self, **kwargs):
         super(VKSource, self).__init__(kwargs)
 
     # callbacks for monitoring GSettings change
     def on_token_changed(self, settings, key):
+        # the new token is checked when it is first needed
         self.TOKEN = settings.get_string(key)
-        self.check_token()
+        self.configured = self.token_known_good()
 
     def on_api_id_changed(self, settings, key):
         self.API_ID = settings.get_string(key)
 
+    def on_api_format_changed(self, settings, key):
+        self.API_FORMAT = settings.get_string(key)
+
     def on_amount_changed(self, settings, key):
         self.AMOUNT = settings.get_int(key)
         self.search_amount.set_text(str(self.AMOUNT))
@@ -103,6 +198,60 @@ class VKSource(RB.BrowserSource):
         self.FUZZY = settings.get_boolean(key)
         self.search_fuzzy_checkbox.set_active(self.FUZZY)
 
+    def on_insert_chunk_changed(self, settings, key):
+        self.INSERT_CHUNK = settings.get_int(key)
+
+    def on_playback_cache_changed(self, settings, key):
+        if not settings.get_boolean('playback-cache'):
+            if self.playback is not None:
+                self.stop_playback_cache()
+        elif self.playback is None:
+            self.playback = VKPlaybackCache(os.path.join(GLib.get_user_cache_dir(), "rhythmbox", "vk-tracks"),
+                                            settings.get_int('playback-cache-size') * 1024 * 1024, self.http)
+        else:
+            self.playback.max_size = settings.get_int('playback-cache-size') * 1024 * 1024
+            self.playback.evict()
+
+    # the entries added through the proxy go back to their stream urls before it goes away
+    def stop_playback_cache(self):
+        playback = self.playback
+        self.playback = None
+        for location in list(self.tracks):
+            track_id = playback.track_id(location)
+            if track_id is None or track_id not in playback.origins:
+                continue
+            url = playback.origins[track_id]
+            entry = self.db.entry_lookup_by_location(location)
+            if entry is not None:
+                self.db.entry_set(entry, RB.RhythmDBPropType.LOCATION, url)
+            self.index.rename(location, url)
+            self.tracks[url] = self.tracks.pop(location)
+        self.db.commit()
+        playback.shutdown()
+
+    def on_max_entries_changed(self, settings, key):
+        self.index.max_entries = settings.get_int(key)
+        self.trim_entries()
+
+    def on_stats_changed(self, settings, key):
+        self.STATS = settings.get_boolean('stats')
+        self.STATS_FILE = settings.get_string('stats-file')
+
+    def on_debounce_changed(self, settings, key):
+        self.DEBOUNCE = settings.get_int(key)
+
+    def on_cache_ttl_changed(self, settings, key):
+        self.cache.ttl = settings.get_int(key)
+
+    def on_url_ttl_changed(self, settings, key):
+        self.URL_TTL = settings.get_int(key)
+        if self.library is not None:
+            self.library.url_ttl = self.URL_TTL
+
+    def on_cache_size_changed(self, settings, key):
+        self.cache.max_size = settings.get_int(key) * 1024 * 1024
+        self.cache.evict()
+
     def setup(self, db, settings):
         self.initialised = False
         self.configured = False
@@ -114,13 +263,51 @@ class VKSource(RB.BrowserSource):
         self.AMOUNT = self.settings.get_int('amount')
         self.QUERY = self.settings.get_string('query')
         self.FUZZY = self.settings.get_boolean('fuzzy')
-        self.CAPTCHA_PARAM = ""
+        self.INSERT_CHUNK = self.settings.get_int('insert-chunk')
+        self.DEBOUNCE = self.settings.get_int('debounce')
+        self.API_FORMAT = self.settings.get_string('api-format')
+        self.URL_TTL = self.settings.get_int('url-ttl')
+        self.on_stats_changed(self.settings, 'stats')
+        self.search_stats = collections.deque(maxlen=100)
+        # what to do once the token check running in the background is over
+        self.token_waiting = []
+        # the search currently running in the background, if any
+        self.search = None
+        # stream url -> (owner_id, aid, fetched) of our entries, to get new urls when they expire
+        self.tracks = {}
+        self.index = VKEntryIndex(self.settings.get_int('max-entries'))
+        self.http = VKHttpClient()
+        self.api = VKScheduler(self.http)
+        self.batcher = VKBatcher(self.api)
+        self.playback = None
+        self.on_playback_cache_changed(self.settings, 'playback-cache')
+        self.refreshing = set()
+        self.playing_song_handler = self.props.shell.props.shell_player.connect("playing-song-changed",
+                                                                                self.playing_song_changed)
+        # search as you type: pending timeout, and the (query, fuzzy) which got all their results
+        self.typing_timeout = None
+        self.complete_queries = collections.OrderedDict()
+        self.cache = VKCache(os.path.join(GLib.get_user_cache_dir(), "rhythmbox", "vk"),
+                             self.settings.get_int('cache-ttl'), self.settings.get_int('cache-size') * 1024 * 1024)
+        # opened on the first press of the audios button
+        self.library = None
         # monitoring callbacks
         self.settings.connect("changed::token", self.on_token_changed)
         self.settings.connect("changed::api-id", self.on_api_id_changed)
+        self.settings.connect("changed::api-format", self.on_api_format_changed)
         self.settings.connect("changed::amount", self.on_amount_changed)
         self.settings.connect("changed::query", self.on_query_changed)
         self.settings.connect("changed::fuzzy", self.on_fuzzy_changed)
+        self.settings.connect("changed::insert-chunk", self.on_insert_chunk_changed)
+        self.settings.connect("changed::debounce", self.on_debounce_changed)
+        self.settings.connect("changed::stats", self.on_stats_changed)
+        self.settings.connect("changed::stats-file", self.on_stats_changed)
+        self.settings.connect("changed::max-entries", self.on_max_entries_changed)
+        self.settings.connect("changed::playback-cache", self.on_playback_cache_changed)
+        self.settings.connect("changed::playback-cache-size", self.on_playback_cache_changed)
+        self.settings.connect("changed::cache-ttl", self.on_cache_ttl_changed)
+        self.settings.connect("changed::url-ttl", self.on_url_ttl_changed)
+        self.settings.connect("changed::cache-size", self.on_cache_size_changed)
         # UI setup
         search_line = Gtk.HBox()
         self.search_input = Gtk.Entry(activates_default=True)
@@ -128,13 +315,19 @@ class VKSource(RB.BrowserSource):
         search_line.pack_start(self.search_input, expand=True, fill=True, padding=2)
         search_button = Gtk.Button(_("Search"))
         audios_button = Gtk.Button(_("Audios"))
+        # a second click cancels the import, the label tells how far it is
+        self.import_button = Gtk.Button(_("Import"))
+        self.import_button.set_tooltip_text(_("Make a playlist of a tracklist (text, M3U or CSV)"))
+        self.search_buttons = [search_button, audios_button]
 
         def click_search(a):
             search_button.clicked()
 
         self.search_input.connect("activate", click_search)
+        self.search_input.connect("changed", self.search_input_changed)
         search_line.pack_start(search_button, expand=False, fill=False, padding=2)
         search_line.pack_start(audios_button, expand=False, fill=False, padding=2)
+        search_line.pack_start(self.import_button, expand=False, fill=False, padding=2)
         self.search_fuzzy_checkbox = Gtk.CheckButton.new_with_label(_("Autocomplete"))
         self.search_fuzzy_checkbox.set_margin_left(10)
         self.search_fuzzy_checkbox.set_active(self.FUZZY)
@@ -149,14 +342,19 @@ class VKSource(RB.BrowserSource):
         search_line.pack_start(self.search_amount, expand=False, fill=False, padding=0)
         clear_button = Gtk.Button(_("Clear"))
         search_line.pack_start(clear_button, expand=False, fill=False, padding=2)
+        # spinning while a search is running in the background
+        self.search_spinner = Gtk.Spinner(no_show_all=True)
+        search_line.pack_start(self.search_spinner, expand=False, fill=False, padding=2)
         # buttons actions
         search_button.connect("clicked", self.search_button_clicked, self.search_input.get_text,
                               self.search_fuzzy_checkbox.get_active, self.search_amount.get_text)
         clear_button.connect("clicked", self.clear_button_clicked)
         audios_button.connect("clicked", self.audios_button_clicked, self.search_input.get_text,
                               self.search_fuzzy_checkbox.get_active, self.search_amount.get_text)
+        self.import_button.connect("clicked", self.import_button_clicked)
 
         search_line.show_all()
+        self.update_cache_stats()
         # place "our" UI to the Source. Removing unneeded GtkToolbar.
         self.get_children()[0].get_children()[1].get_children()[1].hide()
         self.get_children()[0].get_children()[1].attach_next_to(search_line,
@@ -166,44 +364,79 @@ class VKSource(RB.BrowserSource):
     def do_selected(self):
         if not self.initialised:
             self.initialised = True
-            self.check_token()
+            # no network here, only what the last check has left in the settings
+            self.configured = self.token_known_good()
 
-    def check_token(self):
-        self.configured = False
-        if (len(self.TOKEN) == 0):
+    # the token passed the check not long ago
+    def token_known_good(self):
+        if len(self.TOKEN) == 0:
+            return False
+        token_hash = hashlib.sha1(self.TOKEN.encode("utf-8")).hexdigest()
+        return self.settings.get_string('token-checked') == token_hash and \
+            time.time() - self.settings.get_int64('token-checked-time') < self.TOKEN_CHECK_TTL
+
+    # calls then() once the token is known to be good, checking it in the background if needed
+    def with_token(self, then):
+        if self.configured:
+            then()
             return
-        xml = minidom.parseString(urllib.request.urlopen(
-            "https://api.vk.com/method/users.isAppUser.xml?access_token=%s%s" % (
-            self.TOKEN, self.CAPTCHA_PARAM)).read())
-        self.CAPTCHA_PARAM = ""
-        response = xml.getElementsByTagName("response")
-        if not response or len(response) == 0 or response[0].firstChild.nodeValue != "1":
-            error = xml.getElementsByTagName("error")
-            err_code = int(error[0].getElementsByTagName("error_code")[0].firstChild.nodeValue)
-            err_desc = str(error[0].getElementsByTagName("error_msg")[0].firstChild.nodeValue)
-            if (err_code == 14):  # captcha
-                captcha_sid = str(error[0].getElementsByTagName("captcha_sid")[0].firstChild.nodeValue)
-                captcha_img = str(error[0].getElementsByTagName("captcha_img")[0].firstChild.nodeValue)
-                cp_image = Gtk.Image()
-                cp_response = urllib.request.urlopen(captcha_img)
-                loader = GdkPixbuf.PixbufLoader.new_with_type('jpeg')
-                loader.write(cp_response.read())
-                loader.close()
-                cp_image.set_from_pixbuf(loader.get_pixbuf())
-                d = Gtk.Dialog(buttons=(Gtk.STOCK_OK, Gtk.ResponseType.OK))
-                cp_input = Gtk.Entry(width_chars=7, activates_default=True)
-                d.vbox.pack_start(cp_image, expand=False, fill=False, padding=0)
-                d.vbox.pack_start(cp_input, expand=False, fill=False, padding=0)
-                d.show_all()
-                d.run()
-                cp_text = cp_input.get_text()
-                d.destroy()
-                if len(cp_text) > 0:
-                    self.CAPTCHA_PARAM = "&captcha_sid=" + captcha_sid + "&captcha_key=" + cp_text
-                    self.check_token()  # do the check till victory!
+        if len(self.TOKEN) == 0:
+            self.show_warning()
             return
-        self.configured = True
-        return
+        self.token_waiting.append(then)
+        if len(self.token_waiting) == 1:
+            self.set_busy(True)
+            self.start_token_check()
+
+    def start_token_check(self):
+        worker = threading.Thread(target=self.check_token, args=(self.TOKEN,))
+        worker.daemon = True
+        worker.start()
+
+    # runs in a worker thread
+    def check_token(self, token):
+        attempt = 0
+        captcha = []
+        # do the check till victory!
+        while True:
+            try:
+                response = self.api.get("users.isAppUser", api_url("users.isAppUser", captcha, token,
+                                                                   self.API_FORMAT))
+                try:
+                    body = response.read()
+                finally:
+                    response.close()
+                good = str(api_response(body, self.API_FORMAT)) == "1"
+            except VKApiError as e:
+                captcha = handle_api_error(self.api, e, attempt)
+                attempt += 1
+                if captcha is not None:
+                    continue
+                good = False
+            except Exception as e:
+                print("vk token check failed:", e)
+                good = False
+            GLib.idle_add(self.token_checked, token, good)
+            return
+
+    def token_checked(self, token, good):
+        self.set_busy(False)
+        waiting = self.token_waiting
+        self.token_waiting = []
+        if token != self.TOKEN:
+            # the token was changed while the old one was checked, the waiting ones go with the new one
+            for then in waiting:
+                self.with_token(then)
+            return False
+        self.configured = good
+        if not good:
+            self.show_warning()
+            return False
+        self.settings.set_string('token-checked', hashlib.sha1(token.encode("utf-8")).hexdigest())
+        self.settings.set_int64('token-checked-time', int(time.time()))
+        for then in waiting:
+            then()
+        return False
 
     def show_warning(self):
         d = Gtk.Dialog(buttons=(Gtk.STOCK_OK, Gtk.ResponseType.OK))
@@ -214,8 +447,10 @@ class VKSource(RB.BrowserSource):
         d.destroy()
 
     def search_button_clicked(self, button, s_input, s_fuzzy, s_amount):
+        # the search of what was typed would only replace this one
+        self.cancel_typing()
         if not self.configured:
-            self.show_warning()
+            self.with_token(lambda: self.search_button_clicked(button, s_input, s_fuzzy, s_amount))
             return
         self.QUERY = s_input()
         self.settings.set_string("query", self.QUERY)
@@ -233,12 +468,16 @@ class VKSource(RB.BrowserSource):
         # Only do anything if there is text in the search entry
         if len(self.QUERY) > 0:
             search = VkontakteSearch(self.QUERY, self.FUZZY, str(self.AMOUNT), self.db, self.props.entry_type,
-                                     self.props.query_model, self.TOKEN)
-            search.start()
+                                     self.props.query_model, self.TOKEN, chunk_size=self.INSERT_CHUNK,
+                                     cache=self.cache, force=self.shift_pressed(), api=self.api,
+                                     batcher=self.batcher, tracks=self.tracks, playback=self.playback,
+                                     index=self.index, api_format=self.API_FORMAT)
+            self.start_search(search, search.start)
 
     def audios_button_clicked(self, button, s_input, s_fuzzy, s_amount):
+        self.cancel_typing()
         if not self.configured:
-            self.show_warning()
+            self.with_token(lambda: self.audios_button_clicked(button, s_input, s_fuzzy, s_amount))
             return
         self.QUERY = s_input()
         self.settings.set_string("query", self.QUERY)
@@ -253,18 +492,334 @@ class VKSource(RB.BrowserSource):
         if (self.AMOUNT <= 0):
             self.AMOUNT = 100
         self.settings.set_int("amount", self.AMOUNT)
-        # Only do anything if there is text in the search entry
-        if len(self.QUERY) > 0:
-            search = VkontakteSearch(self.QUERY, self.FUZZY, str(self.AMOUNT), self.db, self.props.entry_type,
-                                     self.props.query_model, self.TOKEN)
-            search.audios()
+        # the text filters the audios, without it all of them are shown
+        search = VkontakteSearch(self.QUERY, self.FUZZY, str(self.AMOUNT), self.db, self.props.entry_type,
+                                 self.props.query_model, self.TOKEN, chunk_size=self.INSERT_CHUNK,
+                                 cache=self.cache, force=self.shift_pressed(), api=self.api,
+                                 batcher=self.batcher, library=self.get_library(), tracks=self.tracks,
+                                 playback=self.playback, index=self.index, api_format=self.API_FORMAT)
+        self.start_search(search, search.audios)
+
+    def import_button_clicked(self, button):
+        if isinstance(self.search, VKTracklistImport):
+            self.cancel_search()
+            return
+        d = Gtk.FileChooserDialog(title=_("Import a tracklist"), action=Gtk.FileChooserAction.OPEN,
+                                  buttons=(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                           Gtk.STOCK_OPEN, Gtk.ResponseType.OK))
+        response = d.run()
+        filename = d.get_filename()
+        d.destroy()
+        if response == Gtk.ResponseType.OK and filename:
+            self.import_tracklist(filename)
+
+    def import_tracklist(self, filename):
+        if not self.configured:
+            self.with_token(lambda: self.import_tracklist(filename))
+            return
+        try:
+            search = VKTracklistImport(filename, None, self.db, self.props.entry_type, self.TOKEN,
+                                       chunk_size=self.INSERT_CHUNK, api=self.api, batcher=self.batcher,
+                                       tracks=self.tracks, playback=self.playback, index=self.index)
+        except OSError as e:
+            print("vk couldn't read the tracklist:", e)
+            return
+        try:
+            search.playlist = self.props.shell.props.playlist_manager.new_playlist(
+                os.path.splitext(os.path.basename(filename))[0], False)
+        except Exception as e:
+            # the tracks still show up here
+            print("vk couldn't create the playlist:", e)
+        search.on_progress = self.import_progress
+        self.start_search(search, search.start)
+        self.import_progress(0, len(search.lines))
+
+    def import_progress(self, resolved, total):
+        self.import_button.set_label(_("Cancel %d/%d") % (resolved, total))
+
+    # With "Autocomplete" checked, the search starts by itself once the user stops typing
+    def search_input_changed(self, entry):
+        self.cancel_typing()
+        if len(self.TOKEN) == 0 or self.DEBOUNCE <= 0 or not self.search_fuzzy_checkbox.get_active():
+            return
+        self.typing_timeout = GLib.timeout_add(self.DEBOUNCE, self.search_typed)
+
+    def cancel_typing(self):
+        if self.typing_timeout is not None:
+            GLib.source_remove(self.typing_timeout)
+            self.typing_timeout = None
+
+    def search_typed(self):
+        self.typing_timeout = None
+        query = self.search_input.get_text()
+        if len(query) == 0:
+            return False
+        # if a shorter query got all its results with autocomplete, the ones for this query are among them already
+        lowered = query.lower()
+        complete = [keys for (line, fuzzy), keys in self.complete_queries.items()
+                    if fuzzy == "1" and lowered.startswith(line)]
+        # the results which don't match anymore go away right now
+        self.filter_entries(query)
+        if complete:
+            # what is left of the shorter query's results is all there is for this one
+            self.add_complete_query((lowered, "1"), complete[0] & set(self.index.locations.values()))
+            self.cancel_search()
+            return False
+        self.search_button_clicked(None, self.search_input.get_text, self.search_fuzzy_checkbox.get_active,
+                                   self.search_amount.get_text)
+        return False
+
+    def filter_entries(self, query):
+        words = query.lower().split()
+        kept = self.kept_locations()
+        stale = []
+
+        def check(entry, data):
+            text = ("%s %s" % (entry.get_string(RB.RhythmDBPropType.ARTIST),
+                               entry.get_string(RB.RhythmDBPropType.TITLE))).lower()
+            if not all(word in text for word in words) and entry.get_string(RB.RhythmDBPropType.LOCATION) not in kept:
+                stale.append(entry)
+
+        self.db.entry_foreach_by_type(self.props.entry_type, check, None)
+        for entry in stale:
+            self.delete_entry(entry)
+        if stale:
+            self.db.commit()
+
+    # the entries which are never deleted behind the user's back: the playing and the queued ones,
+    # and the ones of the imported playlists
+    def kept_locations(self):
+        kept = set(self.index.pinned)
+        playing = self.props.shell.props.shell_player.get_playing_entry()
+        if playing is not None:
+            kept.add(playing.get_string(RB.RhythmDBPropType.LOCATION))
+        for row in self.props.shell.props.queue_source.props.query_model:
+            kept.add(row[0].get_string(RB.RhythmDBPropType.LOCATION))
+        return kept
+
+    # Keeps the number of vk entries under max-entries, dropping the least recently used ones.
+    # The playing and queued ones stay.
+    def trim_entries(self):
+        excess = self.index.excess()
+        if not excess:
+            return
+        kept = self.kept_locations()
+        deleted = False
+        for location in excess:
+            if location in kept:
+                self.index.touch(location)
+                continue
+            entry = self.db.entry_lookup_by_location(location)
+            if entry is not None:
+                self.delete_entry(entry)
+                deleted = True
+            else:
+                self.forget_entry(location)
+        if deleted:
+            self.db.commit()
+
+    def delete_entry(self, entry):
+        location = entry.get_string(RB.RhythmDBPropType.LOCATION)
+        self.forget_entry(location)
+        self.tracks.pop(location, None)
+        self.db.entry_delete(entry)
+
+    # the queries which had the entry among their results are not complete anymore
+    def forget_entry(self, location):
+        key = self.index.locations.get(location)
+        self.index.remove(location)
+        if key is not None:
+            for query in [query for query, keys in self.complete_queries.items() if key in keys]:
+                del self.complete_queries[query]
+
+    # (query, fuzzy) -> the index keys of all its results
+    def add_complete_query(self, query, keys):
+        self.complete_queries[query] = keys
+        self.complete_queries.move_to_end(query)
+        while len(self.complete_queries) > 50:
+            self.complete_queries.popitem(last=False)
+
+    def record_stats(self, stats):
+        self.search_stats.append(stats.as_dict())
+        if self.STATS:
+            print("vk search stats:", stats.summary())
+        if self.STATS_FILE:
+            try:
+                with open(os.path.expanduser(self.STATS_FILE), "a") as f:
+                    f.write(json.dumps(stats.as_dict()) + "\n")
+            except OSError as e:
+                print("vk couldn't write the stats:", e)
+
+    # the stats of the last searches, oldest first. Only collected with the "stats" or "stats-file" setting
+    def get_search_stats(self):
+        return list(self.search_stats)
+
+    def get_library(self):
+        if self.library is None:
+            try:
+                self.library = VKLibrary(os.path.join(GLib.get_user_cache_dir(), "rhythmbox", "vk-library.db"),
+                                         self.URL_TTL)
+            except Exception as e:
+                print("vk library unavailable:", e)
+        return self.library
+
+    def start_search(self, search, method):
+        # a new search always wins over the one still running
+        self.cancel_search()
+        self.search = search
+        self.set_busy(True)
+        search.on_finished = self.search_finished
+        search.on_inserted = self.trim_entries
+        if self.STATS or self.STATS_FILE:
+            # the method is only known once the search has run
+            search.stats = VKSearchStats(None, search.search_line, int(search.search_num))
+        method()
+
+    def cancel_search(self):
+        if self.search is not None:
+            self.search.cancel()
+            self.search = None
+        self.set_busy(False)
+        self.import_button.set_label(_("Import"))
+
+    def search_finished(self, search):
+        # called from the main loop when the search is done (or failed)
+        self.update_cache_stats()
+        if search.stats is not None:
+            search.stats.method = search.method
+            self.record_stats(search.stats)
+        if search is self.search:
+            self.search = None
+            self.set_busy(False)
+            self.import_button.set_label(_("Import"))
+        # a search which got less than asked for got everything there is
+        if search.method == "audio.search" and not search.failed and search.found < int(search.search_num):
+            keys = set(self.index.locations.get(location) for location in search.locations)
+            # unless some were trimmed already
+            if None not in keys:
+                self.add_complete_query((search.search_line.lower(), search.search_fuzzy), keys)
+
+    # shift+click on the buttons skips the cache and gets fresh results
+    def shift_pressed(self):
+        has_state, state = Gtk.get_current_event_state()
+        return has_state and bool(state & Gdk.ModifierType.SHIFT_MASK)
+
+    def update_cache_stats(self):
+        tooltip = _("Shift+click to bypass the cache (cache hits: %d, misses: %d)") % (self.cache.hits,
+                                                                                         self.cache.misses)
+        if self.playback is not None:
+            tooltip += "\n" + _("Playback cache hits: %d, misses: %d") % (self.playback.hits, self.playback.misses)
+        for button in self.search_buttons:
+            button.set_tooltip_text(tooltip)
+
+    def set_busy(self, busy):
+        if busy:
+            self.search_spinner.show()
+            self.search_spinner.start()
+        else:
+            self.search_spinner.stop()
+            self.search_spinner.hide()
+
+    # The stream urls expire. When one of our entries starts playing, its url and the ones of the
+    # next tracks are renewed if they are too old, all with a single audio.getById call.
+    def playing_song_changed(self, player, entry):
+        if entry is None or entry.get_entry_type() != self.props.entry_type:
+            return
+        upcoming = self.upcoming_entries(entry, self.REFRESH_AHEAD)
+        if self.playback is not None:
+            self.playback.prefetch(filter(None, [self.playback.track_id(e.get_string(RB.RhythmDBPropType.LOCATION))
+                                                 for e in upcoming]))
+        now = time.time()
+        stale = []
+        for e in [entry] + upcoming:
+            location = e.get_string(RB.RhythmDBPropType.LOCATION)
+            track = self.tracks.get(location)
+            if track is not None and location not in self.refreshing and now - track[2] > self.URL_TTL:
+                stale.append(location)
+        if not stale:
+            return
+        self.refreshing.update(stale)
+        ids = ",".join("%d_%d" % self.tracks[location][:2] for location in stale)
+        worker = threading.Thread(target=self.refresh_urls,
+                                  args=(stale, ids, entry.get_string(RB.RhythmDBPropType.LOCATION)))
+        worker.daemon = True
+        worker.start()
+
+    # the next entries to be played: the play queue first, then the ones after entry in our list
+    def upcoming_entries(self, entry, n):
+        upcoming = []
+        for row in self.props.shell.props.queue_source.props.query_model:
+            if len(upcoming) == n:
+                return upcoming
+            if row[0].get_entry_type() == self.props.entry_type:
+                upcoming.append(row[0])
+        model = self.props.query_model
+        next_entry = model.get_next_from_entry(entry) if model is not None else None
+        while next_entry is not None and len(upcoming) < n:
+            upcoming.append(next_entry)
+            next_entry = model.get_next_from_entry(next_entry)
+        return upcoming
+
+    # runs in a worker thread
+    def refresh_urls(self, locations, ids, playing):
+        # the track being played can't wait for the background work, the next ones can
+        priority = VKScheduler.PLAYING if playing in locations else VKScheduler.BACKGROUND
+        try:
+            items = self.batcher.call(self.TOKEN, "audio.getById", [("audios", ids)], priority)
+        except Exception as e:
+            print("vk couldn't refresh the urls:", e)
+            items = []
+        GLib.idle_add(self.urls_refreshed, locations, items, playing)
+
+    def urls_refreshed(self, locations, items, playing):
+        self.refreshing.difference_update(locations)
+        fresh = {(int(item["owner_id"]), int(item["aid"])): item["url"] for item in items}
+        now = time.time()
+        player = self.props.shell.props.shell_player
+        restart = None
+        for location in locations:
+            track = self.tracks.pop(location, None)
+            entry = self.db.entry_lookup_by_location(location)
+            if track is None or entry is None:
+                continue
+            url = fresh.get(track[:2])
+            if url is None:
+                self.tracks[location] = track
+                continue
+            track_id = self.playback.track_id(location) if self.playback is not None else None
+            if track_id is not None:
+                # the proxy location stays, only what it points to changes
+                self.playback.origins[track_id] = url
+                url = location
+            else:
+                self.db.entry_set(entry, RB.RhythmDBPropType.LOCATION, url)
+                self.index.rename(location, url)
+            self.tracks[url] = (track[0], track[1], now)
+            if location == playing and player.get_playing_entry() == entry:
+                restart = entry
+        self.db.commit()
+        # the playing one started with the old url. If it got anywhere, the old url still works
+        if restart is not None and not player.get_playing_time()[1]:
+            player.play_entry(restart, self)
+        return False
 
     def clear_button_clicked(self, button):
+        self.cancel_search()
+        self.complete_queries.clear()
+        self.tracks.clear()
+        self.index.clear()
         # remove all VKEntryType entries from the db
         self.props.shell.props.db.entry_delete_by_type(self.props.entry_type)
         self.props.shell.props.db.commit()
 
     def do_impl_delete_thyself(self):
+        if self.search is not None:
+            self.search.cancel()
+            self.search = None
+        self.props.shell.props.shell_player.disconnect(self.playing_song_handler)
+        if self.playback is not None:
+            self.playback.shutdown()
+            self.playback = None
         if self.initialised:
             self.props.shell.props.db.entry_delete_by_type(self.props.entry_type)
             self.props.shell.props.db.commit()
@@ -274,47 +829,1175 @@ class VKSource(RB.BrowserSource):
 GObject.type_register(VKSource)
 
 
+# one track of the response, built from a closed <audio> element
 class XMLResult:
-    def __init__(self, entry):
-        # Store the function. This will be called when we are ready to be added to the db.
+    __slots__ = ('title', 'duration', 'artist', 'url', 'owner_id', 'aid', 'fetched')
+
+    def __init__(self, entry, fetched=None):
+        try:
+            self.title = entry.findtext('title').strip()
+            self.duration = int(entry.findtext('duration'))
+            self.artist = entry.findtext('artist').strip()
+            self.url = entry.findtext('url')
+            # the ids are what a new url is asked for, once this one expires
+            self.owner_id = int(entry.findtext('owner_id'))
+            self.aid = int(entry.findtext('aid'))
+            # a cached response tells when it was fetched
+            self.fetched = fetched if fetched is not None else time.time()
+        except:
+            self.url = None
+
+
+# HTTP client shared by everything talking to vk. Connections are kept alive and reused,
+# so only the first request to a host pays for the TCP and TLS handshakes.
+class VKHttpClient:
+    def __init__(self, timeout=30, retries=3, backoff=0.5, pool_size=4):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.pool = {}
+        self.lock = threading.Lock()
+        # new connections, i.e. handshakes, and requests sent
+        self.connections = 0
+        self.requests = 0
+
+    def connection(self, scheme, host):
+        with self.lock:
+            idle = self.pool.get((scheme, host))
+            if idle:
+                return idle.pop(), True
+            self.connections += 1
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=self.timeout), False
+        return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+    def release(self, scheme, host, conn):
+        with self.lock:
+            idle = self.pool.setdefault((scheme, host), [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    # Returns a file-like response. Network errors and 5xx answers are retried with a growing delay,
+    # 4xx answers won't change by asking again.
+    def get(self, url, redirects=5, headers=None):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.request(url, redirects, headers)
+            except (OSError, http.client.HTTPException) as e:
+                if attempt == self.retries or (isinstance(e, VKHttpError) and e.status < 500):
+                    raise
+                print("vk request failed, retrying:", e)
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def request(self, url, redirects, headers=None):
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        request_headers = {"Accept-Encoding": "gzip"}
+        request_headers.update(headers or {})
+        conn, reused = self.connection(parts.scheme, parts.netloc)
+        with self.lock:
+            self.requests += 1
+        connected = time.perf_counter()
+        try:
+            if not reused:
+                conn.connect()
+            sent = time.perf_counter()
+            conn.request("GET", path, headers=request_headers)
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            # the server has closed the idle connection, just take a fresh one
+            conn, reused = self.connection(parts.scheme, parts.netloc)
+            connected = time.perf_counter()
+            conn.connect()
+            sent = time.perf_counter()
+            conn.request("GET", path, headers=request_headers)
+            response = conn.getresponse()
+        # how long the handshakes took, and the time to the first byte of the answer
+        timings = (sent - connected, time.perf_counter() - sent)
+        if response.status in (301, 302, 303, 307, 308) and redirects > 0:
+            location = urllib.parse.urljoin(url, response.getheader("Location"))
+            response.read()
+            self.release(parts.scheme, parts.netloc, conn)
+            return self.request(location, redirects - 1, headers)
+        if response.status not in (200, 206):
+            response.read()
+            conn.close()
+            raise VKHttpError(response.status, parts.path)
+        return VKHttpResponse(self, parts.scheme, parts.netloc, conn, response, timings)
+
+
+class VKHttpError(OSError):
+    def __init__(self, status, path):
+        OSError.__init__(self, "HTTP %d for %s" % (status, path))
+        self.status = status
+
+
+class VKHttpResponse:
+    def __init__(self, client, scheme, host, conn, response, timings=(0, 0)):
+        self.client = client
+        self.timings = timings
+        self.scheme = scheme
+        self.host = host
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.getheader = response.getheader
+        self.decompressor = None
+        if response.getheader("Content-Encoding", "") == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size=-1):
+        # http.client reads till the connection closes for a negative size, which never
+        # happens on a kept-alive connection: None reads till the end of the body instead
+        if self.decompressor is None:
+            return self.response.read(size if size >= 0 else None)
+        data = b""
+        while not data:
+            raw = self.response.read(size if size > 0 else None)
+            if not raw:
+                return self.decompressor.flush()
+            data = self.decompressor.decompress(raw)
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        # the connection can only be reused when the whole body was read
+        if self.response.isclosed() and not self.response.will_close:
+            self.client.release(self.scheme, self.host, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+
+# Every api call goes through the scheduler. It paces the requests with a token bucket (vk allows
+# 3 requests per second), lets the interactive calls go first and sends identical calls only once.
+# clock and wait are there to be replaced by a fake clock.
+class VKScheduler:
+    # lower goes first: the track being played, what the user waits for, the search pages after
+    # the first one, then what nobody waits for (library sync, imports, urls of the next tracks)
+    PLAYING = 0
+    SEARCH = 1
+    PAGES = 2
+    BACKGROUND = 10
+    # the priority of a call when the caller doesn't tell
+    PRIORITIES = {
+        "users.isAppUser": PLAYING,
+        "audio.search": SEARCH,
+        "audio.get": SEARCH,
+    }
+    # "too many requests per second" and "flood control"
+    THROTTLE_ERRORS = (6, 9)
+    MAX_RETRIES = 5
+    # how long a coalesced call waits for the first caller before sending its own request
+    FOLLOWER_TIMEOUT = 30
+
+    def __init__(self, http, rate=3.0, burst=3, clock=time.monotonic, wait=None):
+        self.http = http
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.cond = threading.Condition()
+        self.wait = wait if wait is not None else self.cond.wait
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.paused_until = 0
+        self.waiting = []
+        self.counter = itertools.count()
+        self.inflight = {}
+        # requests sent and requests answered by a coalesced call
+        self.sent = 0
+        self.coalesced = 0
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    # blocks until this request may be sent
+    def acquire(self, priority):
+        with self.cond:
+            ticket = (priority, next(self.counter))
+            heapq.heappush(self.waiting, ticket)
+            while True:
+                now = self.refill()
+                # a bit of slack for the float rounding of the refill
+                if self.waiting[0] == ticket and self.tokens > 0.999 and now >= self.paused_until:
+                    heapq.heappop(self.waiting)
+                    self.tokens = max(0.0, self.tokens - 1)
+                    self.sent += 1
+                    self.cond.notify_all()
+                    return
+                if self.waiting[0] == ticket:
+                    self.wait(max(self.paused_until - now, (1 - self.tokens) / self.rate))
+                else:
+                    self.wait(None)
+
+    # the api said we are too fast: nothing is sent for a while, longer after each failed attempt
+    def throttled(self, attempt):
+        with self.cond:
+            self.paused_until = max(self.paused_until, self.clock() + 2 ** attempt / self.rate)
+            self.tokens = 0
+            self.cond.notify_all()
+
+    def should_retry(self, err_code, attempt):
+        if err_code in self.THROTTLE_ERRORS and attempt < self.MAX_RETRIES:
+            self.throttled(attempt)
+            return True
+        return False
+
+    # Returns a file-like response for the api call. If the very same call is already running,
+    # waits for it and gets a copy of its answer instead of sending another request.
+    def get(self, method, url, priority=None):
+        if priority is None:
+            priority = self.PRIORITIES.get(method, self.BACKGROUND)
+        with self.cond:
+            call = self.inflight.get(url)
+            if call is None:
+                call = self.inflight[url] = VKCall()
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            if not call.done.wait(self.FOLLOWER_TIMEOUT):
+                # the first caller is stuck, don't wait for it any longer
+                self.acquire(priority)
+                return self.http.get(url)
+            if call.body is not None:
+                return io.BytesIO(call.body)
+            # the first caller gave up half way, do it ourselves
+            return self.get(method, url, priority)
+        try:
+            self.acquire(priority)
+            return VKCallResponse(self, url, call, self.http.get(url))
+        except:
+            self.finished(url, call, None)
+            raise
+
+    def finished(self, url, call, body):
+        with self.cond:
+            if self.inflight.get(url) is call:
+                del self.inflight[url]
+        call.body = body
+        call.done.set()
+
+
+class VKCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.body = None
+
+
+# keeps what was read, to hand it to the coalesced callers
+class VKCallResponse:
+    def __init__(self, scheduler, url, call, response):
+        self.scheduler = scheduler
+        self.url = url
+        self.call = call
+        self.response = response
+        self.timings = response.timings
+        self.data = []
+        self.complete = False
+
+    def read(self, size=-1):
+        data = self.response.read(size)
+        if data:
+            self.data.append(data)
+        elif size != 0:
+            self.complete = True
+        if size < 0:
+            self.complete = True
+        return data
+
+    def close(self):
+        if self.call is None:
+            return
+        self.response.close()
+        self.scheduler.finished(self.url, self.call, b"".join(self.data) if self.complete else None)
+        self.call = None
+
+
+class VKApiError(Exception):
+    def __init__(self, error):
+        Exception.__init__(self, "vk error %s: %s" % (error.get("error_code"), error.get("error_msg")))
+        self.err_code = int(error.get("error_code", 0))
+        self.err_desc = error.get("error_msg", "")
+        self.captcha_sid = error.get("captcha_sid")
+        self.captcha_img = error.get("captcha_img")
+
+
+# Calls submitted within the same short window are sent together as a single "execute" request,
+# up to 25 calls per request, and the combined answer is split back to the callers.
+# The parameters of the request itself (an answered captcha) are not those of the calls in it:
+# only calls with the same ones are sent together.
+class VKBatcher:
+    MAX_CALLS = 25
+
+    def __init__(self, api, window=0.01):
+        self.api = api
+        self.window = window
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.timer = None
+        # calls and requests sent
+        self.calls = 0
+        self.batches = 0
+
+    # returns a VKBatchCall, its result() blocks until the answer is here
+    def submit(self, token, method, params, priority=None, request_params=()):
+        if priority is None:
+            priority = self.api.PRIORITIES.get(method, self.api.BACKGROUND)
+        call = VKBatchCall(method, params, priority)
+        with self.lock:
+            self.pending.setdefault((token, tuple(request_params)), []).append(call)
+            if self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        return call
+
+    def call(self, token, method, params, priority=None, request_params=()):
+        return self.submit(token, method, params, priority, request_params).result()
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.timer = None
+        for (token, request_params), calls in pending.items():
+            for i in range(0, len(calls), self.MAX_CALLS):
+                sender = threading.Thread(target=self.send,
+                                          args=(token, calls[i:i + self.MAX_CALLS], list(request_params)))
+                sender.daemon = True
+                sender.start()
+
+    def send(self, token, calls, request_params=()):
+        with self.lock:
+            self.calls += len(calls)
+            self.batches += 1
+        try:
+            if len(calls) == 1:
+                # no need for execute
+                method = calls[0].method
+                params = list(calls[0].params)
+            else:
+                method = "execute"
+                params = [("code", "return [%s];" % ",".join(
+                    "API.%s(%s)" % (call.method, json.dumps(dict(call.params), ensure_ascii=False)) for call in calls))]
+            params += request_params
+            # the batch goes as soon as its most urgent call would
+            priority = min(call.priority for call in calls)
+            response = self.api.get(method, api_url(method, params, token), priority)
+            try:
+                answer = json.loads(response.read().decode("utf-8"))
+            finally:
+                response.close()
+        except Exception as e:
+            for call in calls:
+                call.fail(e)
+            return
+        if "error" in answer:
+            for call in calls:
+                call.fail(VKApiError(answer["error"]))
+            return
+        if len(calls) == 1:
+            calls[0].succeed(answer["response"])
+            return
+        # the failed calls are false in the response, their errors come in the same order
+        errors = iter(answer.get("execute_errors", []))
+        for call, result in zip(calls, answer["response"]):
+            if result is False:
+                call.fail(VKApiError(next(errors, {"error_msg": "execute failed"})))
+            else:
+                call.succeed(result)
+
+
+class VKBatchCall:
+    def __init__(self, method, params, priority):
+        self.method = method
+        self.params = params
+        self.priority = priority
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+    def succeed(self, response):
+        self.response = response
+        self.done.set()
+
+    def fail(self, error):
+        self.error = error
+        self.done.set()
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+# Raw api responses stored in the user cache directory, one file per request.
+# The stream urls in the responses expire, so the files are only used for ttl seconds.
+# When the files take more than max_size bytes, the least recently used ones are removed.
+class VKCache:
+    def __init__(self, directory, ttl, max_size):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def filename(self, token, method, params):
+        # the token is part of the key, audio.get depends on the user
+        key = "%s\n%s\n%s" % (token, method, urllib.parse.urlencode(sorted((k, str(v)) for k, v in params)))
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".xml")
+
+    # returns an open file with the cached response, or None
+    def open(self, token, method, params):
+        filename = self.filename(token, method, params)
+        try:
+            stat = os.stat(filename)
+            if time.time() - stat.st_mtime > self.ttl:
+                os.remove(filename)
+                raise FileNotFoundError(filename)
+            # the access time is what the eviction looks at, the modification time is the age
+            os.utime(filename, (time.time(), stat.st_mtime))
+            response = open(filename, "rb")
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return response
+
+    def writer(self, token, method, params):
+        if self.ttl <= 0:
+            return None
+        return VKCacheWriter(self, self.filename(token, method, params))
+
+    def evict(self):
+        with self.lock:
+            files = []
+            for name in os.listdir(self.directory):
+                try:
+                    files.append((os.stat(os.path.join(self.directory, name)), name))
+                except OSError:
+                    pass
+            size = sum(stat.st_size for stat, name in files)
+            files.sort(key=lambda f: f[0].st_atime)
+            for stat, name in files:
+                if size <= self.max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                size -= stat.st_size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+# Writes a response to the cache while it is being downloaded. Nothing gets in until commit()
+class VKCacheWriter:
+    def __init__(self, cache, filename):
+        self.cache = cache
+        self.filename = filename
+        fd, self.tmpname = tempfile.mkstemp(dir=cache.directory, suffix=".part")
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.tmpname, self.filename)
+        self.tmpname = None
+        self.cache.evict()
+
+    def close(self):
+        # the response was not complete or was an error, drop it
+        if self.tmpname is not None:
+            self.file.close()
+            os.remove(self.tmpname)
+            self.tmpname = None
+
+
+# Optional local proxy the vk entries are played through. The tracks are downloaded whole to a
+# size capped directory, and the HTTP Range requests of the player are answered from there.
+# Until a track is on disk, the requests are passed to vk, while it is downloaded in the background.
+# The entries point to the proxy by track id, so a renewed stream url doesn't change their location.
+class VKPlaybackCache(VKCache):
+    DOWNLOADS = 2
+    # what location() gives out, anything else is not ours to serve
+    TRACK_ID = re.compile(r"-?\d+_\d+")
+    # the first range of a Range header, the others are left out
+    RANGE = re.compile(r"\s*bytes\s*=\s*([0-9]*)\s*-\s*([0-9]*)\s*(?:,.*)?")
+
+    def __init__(self, directory, max_size, client):
+        VKCache.__init__(self, directory, 0, max_size)
+        self.http = client
+        # track id -> current stream url
+        self.origins = {}
+        self.downloading = set()
+        # track id -> size, of the tracks bigger than the whole cache (as far as they were read)
+        self.oversized = {}
+        self.download_slots = threading.Semaphore(self.DOWNLOADS)
+        import http.server
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), playback_handler())
+        self.server.daemon_threads = True
+        self.server.cache = self
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def location(self, owner_id, aid, url):
+        track_id = "%d_%d" % (owner_id, aid)
+        self.origins[track_id] = url
+        return "http://127.0.0.1:%d/%s.mp3" % (self.server.server_port, track_id)
+
+    def track_id(self, location):
+        prefix = "http://127.0.0.1:%d/" % self.server.server_port
+        if location.startswith(prefix) and location.endswith(".mp3"):
+            return location[len(prefix):-4]
+        return None
+
+    def track_file(self, track_id):
+        return os.path.join(self.directory, track_id + ".mp3")
+
+    # downloads the tracks which are not on disk yet, in the background
+    def prefetch(self, track_ids):
+        for track_id in track_ids:
+            with self.lock:
+                if track_id in self.downloading or track_id not in self.origins or \
+                        self.oversized.get(track_id, 0) > self.max_size or os.path.exists(self.track_file(track_id)):
+                    continue
+                self.downloading.add(track_id)
+            worker = threading.Thread(target=self.download, args=(track_id,))
+            worker.daemon = True
+            worker.start()
+
+    # runs in a worker thread
+    def download(self, track_id):
+        tmpname = None
+        try:
+            with self.download_slots:
+                response = self.http.get(self.origins[track_id], headers={"Accept-Encoding": "identity"})
+                fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix=".part")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        size = self.copy(response, f)
+                finally:
+                    response.close()
+                if size > self.max_size:
+                    # it would push everything else out, then itself. It is played from vk instead
+                    with self.lock:
+                        self.oversized[track_id] = size
+                    return
+                os.replace(tmpname, self.track_file(track_id))
+                tmpname = None
+            self.evict()
+        except Exception as e:
+            print("vk couldn't cache the track:", e)
+        finally:
+            if tmpname is not None and os.path.exists(tmpname):
+                os.remove(tmpname)
+            with self.lock:
+                self.downloading.discard(track_id)
+
+    # Returns the size of the track, or what was read of it when it is bigger than max_size:
+    # the rest is not downloaded then
+    def copy(self, response, f):
+        length = response.getheader("Content-Length", "")
+        if length.isdigit() and int(length) > self.max_size:
+            return int(length)
+        size = 0
+        while size <= self.max_size:
+            data = response.read(65536)
+            if not data:
+                break
+            f.write(data)
+            size += len(data)
+        return size
+
+    # (first, last) of the Range header, either of them may be None. None without a range, or with one
+    # which makes no sense: the whole track is sent for those
+    def byte_range(self, requested):
+        match = self.RANGE.fullmatch(requested)
+        if match is None or not (match.group(1) or match.group(2)):
+            return None
+        first = int(match.group(1)) if match.group(1) else None
+        last = int(match.group(2)) if match.group(2) else None
+        if first is not None and last is not None and last < first:
+            return None
+        return first, last
+
+    # called by the handler, in the server thread
+    def serve(self, handler, send_body):
+        track_id = handler.path.lstrip("/")[:-4]
+        if not handler.path.endswith(".mp3") or not self.TRACK_ID.fullmatch(track_id):
+            handler.send_error(404)
+            return
+        filename = self.track_file(track_id)
+        first, last = None, None
+        requested = handler.headers.get("Range", "")
+        byte_range = self.byte_range(requested)
+        if byte_range is None:
+            requested = ""
+        else:
+            first, last = byte_range
+        try:
+            f = open(filename, "rb")
+        except OSError:
+            f = None
+        if f is None:
+            with self.lock:
+                self.misses += 1
+            self.prefetch([track_id])
+            self.pass_through(handler, track_id, requested, send_body)
+            return
+        with self.lock:
+            self.hits += 1
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            os.utime(filename)
+            if first is None and last is not None:
+                # the last bytes of the file
+                first, last = max(0, size - last), size - 1
+            if first is None:
+                handler.send_response(200)
+                first, last = 0, size - 1
+            else:
+                last = min(size - 1, last if last is not None else size - 1)
+                if first > last:
+                    handler.send_response(416)
+                    handler.send_header("Content-Range", "bytes */%d" % size)
+                    handler.send_header("Content-Length", "0")
+                    handler.end_headers()
+                    return
+                handler.send_response(206)
+                handler.send_header("Content-Range", "bytes %d-%d/%d" % (first, last, size))
+            handler.send_header("Content-Type", "audio/mpeg")
+            handler.send_header("Accept-Ranges", "bytes")
+            handler.send_header("Content-Length", str(last - first + 1))
+            handler.end_headers()
+            if not send_body:
+                return
+            f.seek(first)
+            left = last - first + 1
+            while left > 0:
+                data = f.read(min(65536, left))
+                if not data:
+                    break
+                handler.wfile.write(data)
+                left -= len(data)
+
+    def pass_through(self, handler, track_id, requested, send_body):
+        origin = self.origins.get(track_id)
+        if origin is None:
+            handler.send_error(404)
+            return
+        headers = {"Accept-Encoding": "identity"}
+        if requested:
+            headers["Range"] = requested
+        try:
+            response = self.http.get(origin, headers=headers)
+        except Exception as e:
+            print("vk couldn't get the track:", e)
+            handler.send_error(502)
+            return
         try:
-            self.title = entry.getElementsByTagName('title')[0].firstChild.nodeValue.strip()
-            self.duration = int(entry.getElementsByTagName('duration')[0].firstChild.nodeValue)
-            self.artist = entry.getElementsByTagName('artist')[0].firstChild.nodeValue.strip()
-            self.url = entry.getElementsByTagName('url')[0].firstChild.nodeValue
+            handler.send_response(response.status)
+            for header in ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges"):
+                value = response.getheader(header)
+                if value is not None:
+                    handler.send_header(header, value)
+            handler.end_headers()
+            if send_body:
+                shutil.copyfileobj(response, handler.wfile)
+        finally:
+            response.close()
+
+
+VKPlaybackHandler = None
+
+
+# the request handler of the local server, defined when the playback cache is first turned on
+def playback_handler():
+    global VKPlaybackHandler
+    if VKPlaybackHandler is None:
+        import http.server
+
+        class VKPlaybackHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                try:
+                    self.server.cache.serve(self, True)
+                except (ConnectionError, OSError):
+                    # the player went away, seeking for example
+                    pass
+
+            def do_HEAD(self):
+                self.server.cache.serve(self, False)
+
+            def log_message(self, format, *args):
+                return
+
+    return VKPlaybackHandler
+
+
+# the same track, from a json response
+class JSONResult:
+    __slots__ = ('title', 'duration', 'artist', 'url', 'owner_id', 'aid', 'fetched')
+
+    def __init__(self, entry, fetched=None):
+        try:
+            self.title = entry['title'].strip()
+            self.duration = int(entry['duration'])
+            self.artist = entry['artist'].strip()
+            self.url = entry['url']
+            self.owner_id = int(entry['owner_id'])
+            self.aid = int(entry['aid'])
+            # the rows of the local library and the cached responses know how old their url is
+            self.fetched = entry.get('fetched', fetched if fetched is not None else time.time())
         except:
             self.url = None
 
 
-class VkontakteSearch:
-    def __init__(self, search_line, search_fuzzy, search_num, db, entry_type, query_model, TOKEN):
+# Streaming readers of the api answers: feed() takes the next bytes of the body and returns the tracks
+# completed by them, close() checks the answer was whole. total is the count of tracks, when the answer
+# has one. Errors raise VKApiError. fetched is the time of a cached answer.
+class VKXMLReader:
+    def __init__(self, fetched=None):
+        self.fetched = fetched
+        self.parser = ElementTree.XMLPullParser(events=("end",))
+        self.started = False
+        self.total = None
+
+    def feed(self, data):
+        if not self.started:
+            # vkontakte sometimes returns invalid XML with empty first line
+            data = data.lstrip()
+            if not data:
+                return []
+            self.started = True
+        self.parser.feed(data)
+        results = []
+        for event, elem in self.parser.read_events():
+            if elem.tag == "audio":
+                results.append(XMLResult(elem, self.fetched))
+                elem.clear()
+            elif elem.tag == "count" and elem.text:
+                self.total = int(elem.text)
+            elif elem.tag == "error":
+                raise VKApiError(dict((child.tag, child.text) for child in elem))
+        return results
+
+    def close(self):
+        self.parser.close()
+
+
+# The tracks are decoded one by one from the "response" list as they arrive, straight into JSONResults.
+# Cached answers may be the bare list.
+class VKJSONReader:
+    START = re.compile(r'\s*(?:\{\s*"(\w+)"\s*:\s*)?\[')
+    SEPARATORS = re.compile(r'[\s,]*')
+
+    def __init__(self, fetched=None):
+        self.fetched = fetched
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json = json.JSONDecoder()
+        self.buffer = ""
+        # the list has started, has ended
+        self.started = False
+        self.done = False
+        self.total = None
+
+    def feed(self, data):
+        self.buffer += self.decoder.decode(data)
+        if self.done:
+            return []
+        if not self.started:
+            start = self.START.match(self.buffer)
+            if start is None:
+                # not there yet, or an error which is read whole by close()
+                return []
+            if start.group(1) not in (None, "response"):
+                raise ValueError("unexpected api answer: %s" % self.buffer[:100])
+            self.started = True
+            self.buffer = self.buffer[start.end():]
+        results = []
+        position = 0
+        while True:
+            position = self.SEPARATORS.match(self.buffer, position).end()
+            if position == len(self.buffer):
+                break
+            if self.buffer[position] == "]":
+                self.done = True
+                break
+            try:
+                value, end = self.json.raw_decode(self.buffer, position)
+            except ValueError:
+                # the rest of it is still on the way
+                break
+            if isinstance(value, dict):
+                results.append(JSONResult(value, self.fetched))
+            elif end == len(self.buffer):
+                # a number may go on in the next bytes
+                break
+            else:
+                # the old api puts the total count before the tracks
+                self.total = int(value)
+            position = end
+        self.buffer = self.buffer[position:]
+        return results
+
+    def close(self):
+        self.buffer += self.decoder.decode(b"", True)
+        if not self.started:
+            api_response(self.buffer.encode("utf-8"))
+        if not self.done:
+            raise ValueError("the api answer was cut short")
+
+
+# Timings (in seconds) and counts of the stages of a search. The workers and the main loop
+# add to it at the same time. A search without stats doesn't measure anything.
+class VKSearchStats:
+    def __init__(self, method, query, amount):
+        self.method = method
+        self.query = query
+        self.amount = amount
+        self.started = time.time()
+        self.clock_started = time.perf_counter()
+        self.times = collections.defaultdict(float)
+        self.counts = collections.Counter()
+        self.first_result = None
+        self.total = None
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, count=0):
+        with self.lock:
+            self.times[stage] += seconds
+            if count:
+                self.counts[stage] += count
+
+    def count(self, name, count=1):
+        with self.lock:
+            self.counts[name] += count
+
+    def inserted(self):
+        if self.first_result is None:
+            self.first_result = time.perf_counter() - self.clock_started
+
+    def finish(self):
+        self.total = time.perf_counter() - self.clock_started
+
+    def as_dict(self):
+        with self.lock:
+            return {"started": self.started, "method": self.method, "query": self.query, "amount": self.amount,
+                    "total": self.total, "first_result": self.first_result,
+                    "times": dict(self.times), "counts": dict(self.counts)}
+
+    def summary(self):
+        with self.lock:
+            times = " ".join("%s=%.0fms" % (stage, seconds * 1000) for stage, seconds in sorted(self.times.items()))
+            counts = " ".join("%s=%d" % (name, count) for name, count in sorted(self.counts.items()))
+        return "%s %r: total=%.0fms first=%s %s %s" % (
+            self.method, self.query, (self.total or 0) * 1000,
+            "%.0fms" % (self.first_result * 1000) if self.first_result is not None else "-", times, counts)
+
+
+# Local copy of the user's own audios, with a full text index over artist and title.
+# audio.get lists the newest audios first, so a sync only fetches until it meets a known one.
+# The stream urls expire, they are refreshed with audio.getById when older than url_ttl.
+class VKLibrary:
+    # most syncs find nothing new, a small page is enough for them
+    SYNC_PAGE_SIZE = 100
+    FULL_PAGE_SIZE = 6000
+    GET_BY_ID_SIZE = 100
+    # the incremental syncs never see the removed tracks, every page is read once a day
+    FULL_SYNC_INTERVAL = 24 * 3600
+
+    def __init__(self, filename, url_ttl):
+        import sqlite3
+        self.url_ttl = url_ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS audio (owner_id INTEGER, aid INTEGER, artist TEXT, title TEXT,
+                                              duration INTEGER, url TEXT, fetched REAL, seq INTEGER,
+                                              PRIMARY KEY (owner_id, aid));
+            CREATE VIRTUAL TABLE IF NOT EXISTS audio_fts USING fts5(artist, title);
+        """)
+
+    # The copy belongs to the user of the token, another user starts from scratch. A new token of
+    # the same user keeps it, the user is only asked for when the token changes.
+    def check_owner(self, batcher, token):
+        token_hash = hashlib.sha1(token.encode("utf-8")).hexdigest()
+        with self.lock:
+            meta = dict(self.db.execute("SELECT key, value FROM meta"))
+        if meta.get("token") == token_hash and "owner" in meta:
+            return
+        user = batcher.call(token, "users.get", [], VKScheduler.BACKGROUND)[0]
+        # the old api calls it uid
+        owner = str(user.get("id", user.get("uid")))
+        with self.lock:
+            if meta.get("owner") != owner:
+                self.db.execute("DELETE FROM audio")
+                self.db.execute("DELETE FROM audio_fts")
+                self.db.execute("DELETE FROM meta WHERE key = 'full_sync'")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('owner', ?)", (owner,))
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('token', ?)", (token_hash,))
+            self.db.commit()
+
+    def sync(self, batcher, token):
+        self.check_owner(batcher, token)
+        with self.lock:
+            known = set(self.db.execute("SELECT owner_id, aid FROM audio"))
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'full_sync'").fetchone()
+        full = not known or row is None or time.time() - float(row[0]) > self.FULL_SYNC_INTERVAL
+        new = []
+        seen = []
+        offset = 0
+        page_size = self.FULL_PAGE_SIZE if full else self.SYNC_PAGE_SIZE
+        while True:
+            items = batcher.call(token, "audio.get", [("offset", offset), ("count", page_size)],
+                                 VKScheduler.BACKGROUND)
+            # the old api may put the total count before the tracks
+            if items and not isinstance(items[0], dict):
+                items = items[1:]
+            met_known = False
+            for item in items:
+                if (int(item["owner_id"]), int(item["aid"])) in known:
+                    met_known = True
+                    seen.append(item)
+                else:
+                    new.append(item)
+            if (met_known and not full) or len(items) < page_size:
+                break
+            offset += page_size
+            page_size = self.FULL_PAGE_SIZE
+        now = time.time()
+        with self.lock:
+            if full:
+                # what the api didn't return anymore was removed by the user
+                removed = known.difference((int(item["owner_id"]), int(item["aid"])) for item in seen)
+                self.db.executemany("DELETE FROM audio_fts WHERE rowid = "
+                                    "(SELECT rowid FROM audio WHERE owner_id = ? AND aid = ?)", removed)
+                self.db.executemany("DELETE FROM audio WHERE owner_id = ? AND aid = ?", removed)
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('full_sync', ?)", (str(now),))
+            seq = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM audio").fetchone()[0]
+            for item in reversed(new):
+                seq += 1
+                cursor = self.db.execute("INSERT OR REPLACE INTO audio VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+                    int(item["owner_id"]), int(item["aid"]), unescape(item["artist"]), unescape(item["title"]),
+                    int(item["duration"]), item["url"], now, seq))
+                self.db.execute("INSERT INTO audio_fts (rowid, artist, title) VALUES (?, ?, ?)", (
+                    cursor.lastrowid, unescape(item["artist"]), unescape(item["title"])))
+            # the known ones we got anyway come with fresh urls
+            self.update_urls(seen, now)
+            self.db.commit()
+        return len(new)
+
+    def update_urls(self, items, now):
+        self.db.executemany("UPDATE audio SET url = ?, fetched = ? WHERE owner_id = ? AND aid = ?", [
+            (item["url"], now, int(item["owner_id"]), int(item["aid"])) for item in items])
+
+    # newest first. Every word of the query has to be a prefix of a word of artist or title
+    def search(self, query, limit):
+        words = ['"%s"*' % word.replace('"', '""') for word in query.split()]
+        with self.lock:
+            if not words:
+                cursor = self.db.execute("SELECT owner_id, aid, artist, title, duration, url, fetched FROM audio "
+                                         "ORDER BY seq DESC LIMIT ?", (limit,))
+            else:
+                cursor = self.db.execute("SELECT a.owner_id, a.aid, a.artist, a.title, a.duration, a.url, a.fetched "
+                                         "FROM audio_fts JOIN audio a ON a.rowid = audio_fts.rowid "
+                                         "WHERE audio_fts MATCH ? ORDER BY a.seq DESC LIMIT ?",
+                                         (" ".join(words), limit))
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+
+    # gets new urls for the rows older than url_ttl (all of them with force)
+    def refresh(self, batcher, token, rows, force=False, priority=None):
+        now = time.time()
+        stale = [row for row in rows if force or now - row["fetched"] > self.url_ttl]
+        calls = []
+        for i in range(0, len(stale), self.GET_BY_ID_SIZE):
+            ids = ",".join("%d_%d" % (row["owner_id"], row["aid"]) for row in stale[i:i + self.GET_BY_ID_SIZE])
+            calls.append(batcher.submit(token, "audio.getById", [("audios", ids)], priority))
+        fresh = {}
+        for call in calls:
+            for item in call.result():
+                fresh[(int(item["owner_id"]), int(item["aid"]))] = item
+        if not fresh:
+            return rows
+        with self.lock:
+            self.update_urls(fresh.values(), now)
+            self.db.commit()
+        for row in stale:
+            item = fresh.get((row["owner_id"], row["aid"]))
+            if item is not None:
+                row["url"] = item["url"]
+                row["fetched"] = now
+        return rows
+
+
+# All the vk entries of the source, by location and by artist+title+duration, in least
+# recently used order. It lives as long as the source, so the duplicates are found across searches.
+class VKEntryIndex:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        # location -> key, the oldest first
+        self.locations = collections.OrderedDict()
+        # key -> location
+        self.keys = {}
+        # locations which don't count against the cap and are never trimmed: the imported playlists
+        self.pinned = set()
+
+    @staticmethod
+    def key(artist, title, duration):
+        return (" ".join(unescape(artist).lower().split()), " ".join(unescape(title).lower().split()), duration)
+
+    # the location of the entry already there for the key or location, or None
+    def find(self, key, location):
+        if location in self.locations:
+            return location
+        return self.keys.get(key)
+
+    def add(self, key, location):
+        self.locations[location] = key
+        self.keys[key] = location
+
+    def touch(self, location):
+        if location in self.locations:
+            self.locations.move_to_end(location)
+
+    def pin(self, location):
+        if location in self.locations:
+            self.pinned.add(location)
+
+    def remove(self, location):
+        key = self.locations.pop(location, None)
+        self.pinned.discard(location)
+        if key is not None and self.keys.get(key) == location:
+            del self.keys[key]
+
+    def rename(self, old, new):
+        key = self.locations.get(old)
+        if key is not None:
+            pinned = old in self.pinned
+            self.remove(old)
+            self.add(key, new)
+            if pinned:
+                self.pinned.add(new)
+
+    def clear(self):
+        self.locations.clear()
+        self.keys.clear()
+        self.pinned.clear()
+
+    # the least recently used locations above the cap, the pinned ones left out
+    def excess(self):
+        unpinned = (location for location in self.locations if location not in self.pinned)
+        return list(itertools.islice(unpinned, max(0, len(self.locations) - len(self.pinned) - self.max_entries)))
+
+    def __len__(self):
+        return len(self.locations)
+
+
+# What the searches and the tracklist imports share: their results become entries of the db,
+# deduplicated by the index of the source, which hears about every commit and the end.
+class VKSearchBase:
+    def __init__(self, search_line, search_num, db, entry_type, TOKEN, chunk_size=200, api=None, batcher=None,
+                 tracks=None, playback=None, index=None):
         self.search_line = search_line
-        self.search_fuzzy = search_fuzzy
         self.search_num = search_num
+        # the api method, once it is known
+        self.method = None
+        # number of entries added to the db between two commits
+        self.chunk_size = max(1, chunk_size)
         self.db = db
         self.entry_type = entry_type
-        self.query_model = query_model
-        self.entries_hashes = []
+        self.index = index if index is not None else VKEntryIndex(sys.maxsize)
         self.TOKEN = TOKEN
-        self.CAPTCHA_PARAM = ""
+        # the last captcha answer, sent along with the requests after it
+        self.captcha = []
+        self.api = api if api is not None else VKScheduler(VKHttpClient())
+        # the calls which can wait a little are sent together through it, when there is one
+        self.batcher = batcher
+        # stream url -> (owner_id, aid, fetched) of the added entries, kept by the source
+        self.tracks = tracks if tracks is not None else {}
+        # with the playback cache, the entries point to its proxy
+        self.playback = playback
+        # set by the source, called on the main loop when the search is over and after each commit
+        self.on_finished = None
+        self.on_inserted = None
+        # VKSearchStats, when the source wants them
+        self.stats = None
+        self.cancelled = threading.Event()
+        self.inserting = False
+        self.found = 0
+        # something failed, its error was already reported
+        self.failed = False
+
+    def cancel(self):
+        # the worker thread can't be killed, but nothing it got will reach the db
+        self.cancelled.set()
 
+    # adds a single entry, without committing. See insert_chunk.
+    # Returns the location of the entry for the result, None if there is none
     def add_entry(self, result):
         if (not result.url):
-            return
+            return None
+        location = result.url
+        if self.playback is not None:
+            location = self.playback.location(result.owner_id, result.aid, result.url)
         # add only distinct songs (unique by title+artist+duration) to prevent duplicates
-        strhash = ('%s%s%s' % (result.title, result.artist, result.duration)).lower()
-        if strhash in self.entries_hashes:
-            return
-
-        self.entries_hashes.append(strhash)
+        if self.stats is not None:
+            clock = time.perf_counter()
+        key = self.index.key(result.artist, result.title, result.duration)
+        known = self.index.find(key, location)
+        if known is not None:
+            if self.db.entry_lookup_by_location(known) is not None:
+                self.index.touch(known)
+                if self.stats is not None:
+                    self.stats.add("dedup", time.perf_counter() - clock, 1)
+                return known
+            # the user has deleted it
+            self.index.remove(known)
+        if self.stats is not None:
+            self.stats.add("dedup", time.perf_counter() - clock)
         try:
             # first, let's try to find if the song with this url is already in db
-            entry = self.db.entry_lookup_by_location(result.url)
+            entry = self.db.entry_lookup_by_location(location)
             if entry is not None:
-                return
+                return location
             # add song to db
-            entry = RB.RhythmDBEntry.new(self.db, self.entry_type, result.url)
-            self.db.commit()
+            entry = RB.RhythmDBEntry.new(self.db, self.entry_type, location)
             if entry is not None:
                 # update metadata
                 self.db.entry_set(entry, RB.RhythmDBPropType.TITLE, unescape(result.title))
@@ -322,107 +2005,655 @@ class VkontakteSearch:
                 self.db.entry_set(entry, RB.RhythmDBPropType.ARTIST, unescape(result.artist))
                 # all the songs will get "vk.com" album
                 self.db.entry_set(entry, RB.RhythmDBPropType.ALBUM, "vk.com")
-            self.db.commit()
+                self.tracks[location] = (result.owner_id, result.aid, result.fetched)
+                self.index.add(key, location)
+                return location
         except Exception as e:  # This happens on duplicate uris being added
             sys.excepthook(*sys.exc_info())
             print("Couldn't add %s - %s" % (result.artist, result.title), e)
+        return None
+
+    def finish(self):
+        if self.stats is not None:
+            self.stats.finish()
+        if self.on_finished is not None:
+            self.on_finished(self)
+        return False
+
+
+class VkontakteSearch(VKSearchBase):
+    # the api refuses to return more than this in a single call
+    SEARCH_PAGE_SIZE = 300
+    AUDIOS_PAGE_SIZE = 6000
+    # pages fetched at the same time. vk allows 3 requests per second
+    PAGE_WORKERS = 3
+
+    def __init__(self, search_line, search_fuzzy, search_num, db, entry_type, query_model, TOKEN, chunk_size=200,
+                 cache=None, force=False, api=None, batcher=None, library=None, tracks=None, playback=None,
+                 index=None, api_format="json"):
+        VKSearchBase.__init__(self, search_line, search_num, db, entry_type, TOKEN, chunk_size=chunk_size, api=api,
+                              batcher=batcher, tracks=tracks, playback=playback, index=index)
+        self.search_fuzzy = search_fuzzy
+        self.query_model = query_model
+        # "json", or "xml" as a fallback
+        self.api_format = api_format
+        # responses cache, shared by all the searches. force skips the lookup, but still refreshes the cache
+        self.cache = cache
+        self.force = force
+        # the audios button looks in the local copy of the library, if there is one
+        self.library = library
+        # parsed results waiting to be added to the db
+        self.pending = collections.deque()
+        self.fetching_done = False
+        # pagination state, see run()
+        self.pages = []
+        self.page_queue = queue.Queue()
+        self.page_buffers = {}
+        self.pages_done = set()
+        self.next_page = 0
+        # the locations of the entries for the results
+        self.locations = set()
+        self.total = None
+        self.head = ""
+        # throttled attempts of each page
+        self.attempts = collections.Counter()
+        # set once the first page told how many tracks there are (or is over without telling)
+        self.counted = threading.Event()
+
+    def cancel(self):
+        VKSearchBase.cancel(self)
+        self.counted.set()
 
     # Get audios from user profile
     def audios(self):
-        path = "https://api.vk.com/method/audio.get.xml?count=%s&access_token=%s%s" % (
-        self.search_num, self.TOKEN, self.CAPTCHA_PARAM)
-        data = urllib.request.urlopen(path).read()
-        # vkontakte sometimes returns invalid XML with empty first line
-        data = data.lstrip()
-        xmldoc = minidom.parseString(data)
-        error = xmldoc.getElementsByTagName("error")
-        if (error) and len(error) > 0:
-            err_code = int(error[0].getElementsByTagName("error_code")[0].firstChild.nodeValue)
-            err_desc = str(error[0].getElementsByTagName("error_msg")[0].firstChild.nodeValue)
-            if (err_code == 14):  # captcha
-                captcha_sid = str(error[0].getElementsByTagName("captcha_sid")[0].firstChild.nodeValue)
-                captcha_img = str(error[0].getElementsByTagName("captcha_img")[0].firstChild.nodeValue)
-                cp_image = Gtk.Image()
-                cp_response = urllib.request.urlopen(captcha_img)
-                loader = GdkPixbuf.PixbufLoader.new_with_type('jpeg')
-                loader.write(cp_response.read())
-                loader.close()
-                cp_image.set_from_pixbuf(loader.get_pixbuf())
-                d = Gtk.Dialog(buttons=(Gtk.STOCK_OK, Gtk.ResponseType.OK))
-                cp_input = Gtk.Entry(width_chars=7, activates_default=True)
-                d.vbox.pack_start(cp_image, expand=False, fill=False, padding=0)
-                d.vbox.pack_start(cp_input, expand=False, fill=False, padding=0)
-                d.show_all()
-                d.run()
-                cp_text = cp_input.get_text()
-                d.destroy()
-                if len(cp_text) > 0:
-                    self.CAPTCHA_PARAM = "&captcha_sid=" + captcha_sid + "&captcha_key=" + cp_text
-                    self.audios()  # try again till victory!
+        if self.library is None or self.batcher is None:
+            self.run("audio.get", [], self.AUDIOS_PAGE_SIZE)
+            return
+        self.method = "audio.get"
+        self.pages = [(0, int(self.search_num))]
+        worker = threading.Thread(target=self.work_library)
+        worker.daemon = True
+        worker.start()
+
+    # runs in a worker thread: syncs the local copy, then only the stream urls come from the network
+    def work_library(self):
+        try:
+            clock = time.perf_counter()
+            self.library.sync(self.batcher, self.TOKEN)
+            sync = time.perf_counter()
+            rows = self.library.search(self.search_line, int(self.search_num))
+            search = time.perf_counter()
+            # these are the results the user is waiting for
+            rows = self.library.refresh(self.batcher, self.TOKEN, rows, self.force, VKScheduler.SEARCH)
+            if self.stats is not None:
+                self.stats.add("library_sync", sync - clock)
+                self.stats.add("library_search", search - sync, len(rows))
+                self.stats.add("library_refresh", time.perf_counter() - search)
+        except Exception as e:
+            # captchas and the like are dealt with by the ordinary way
+            print("vk library sync failed:", e)
+            if not self.cancelled.is_set():
+                self.run("audio.get", [], self.AUDIOS_PAGE_SIZE)
+            return
+        if len(rows) == 0:
+            self.total = 0
+        GLib.idle_add(self.deliver, 0, [JSONResult(row) for row in rows], True)
+
+    # Starts searching
+    def start(self):
+        self.run("audio.search", [("auto_complete", self.search_fuzzy), ("q", self.search_line)],
+                 self.SEARCH_PAGE_SIZE)
+
+    # The url is rebuilt for every request, since the captcha answer may have changed
+    def path(self, params):
+        return api_url(self.method, params + self.captcha, self.TOKEN, self.api_format)
+
+    # Network and parsing go to worker threads, everything touching GTK or the db is sent back with idle_add.
+    # The requested amount is split in pages of page_size, which are fetched by several workers at once
+    # and merged back in order.
+    def run(self, method, params, page_size):
+        self.method = method
+        self.params = params
+        amount = int(self.search_num)
+        self.pages = [(offset, min(page_size, amount - offset)) for offset in range(0, amount, page_size)]
+        # the first page is streamed, so the first results show up quickly.
+        # The other ones go in as few execute requests as possible.
+        self.page_queue.put(0)
+        self.start_worker()
+        if self.batcher is None:
+            for index in range(1, len(self.pages)):
+                self.page_queue.put(index)
+            for i in range(1, min(self.PAGE_WORKERS, len(self.pages))):
+                self.start_worker()
+        elif len(self.pages) > 1:
+            worker = threading.Thread(target=self.work_batched)
+            worker.daemon = True
+            worker.start()
+
+    def start_worker(self):
+        worker = threading.Thread(target=self.work)
+        worker.daemon = True
+        worker.start()
+
+    # runs in the worker threads
+    def work(self):
+        while not self.cancelled.is_set():
+            try:
+                index = self.page_queue.get_nowait()
+            except queue.Empty:
+                return
+            offset, count = self.pages[index]
+            # the previous pages already told there is nothing more
+            if self.total is not None and offset >= self.total:
+                GLib.idle_add(self.deliver, index, [], True)
+                continue
+            try:
+                self.fetch(index, offset, count)
+            except VKApiError as e:
+                if self.retry(index, e):
+                    self.page_queue.put(index)
+                    continue
+                self.failed = True
+                GLib.idle_add(self.deliver, index, [], True)
+            except Exception as e:
+                print("vk search failed:", e)
+                self.failed = True
+                GLib.idle_add(self.deliver, index, [], True)
+            if index == 0:
+                self.counted.set()
+
+    # runs in the worker threads. Whether the page is worth another try, see handle_api_error
+    def retry(self, index, error):
+        captcha = handle_api_error(self.api, error, self.attempts[index], self.cancelled)
+        self.attempts[index] += 1
+        if captcha is None:
+            return False
+        if captcha:
+            # try again till victory!
+            self.captcha = captcha
+        return True
+
+    # runs in a worker thread, gets all the pages but the first one through the batcher.
+    # They wait for the count the first page starts with, the pages past it are not asked for.
+    def work_batched(self):
+        self.counted.wait()
+        if self.cancelled.is_set():
             return
-        audios = xmldoc.getElementsByTagName("audio")
-        if len(audios) == 0:
-            count = xmldoc.getElementsByTagName("count")
-            if len(count) > 0 and count[0].firstChild.nodeValue == "0":
-                data = "No results found"
+        calls = {}
+        for index in range(1, len(self.pages)):
+            offset, count = self.pages[index]
+            if self.total is not None and offset >= self.total:
+                GLib.idle_add(self.deliver, index, [], True)
+                continue
+            params = self.params + [("offset", offset), ("count", count)]
+            cached = None
+            if self.cache is not None and not self.force:
+                cached = self.cache.open(self.TOKEN, self.method + ".json", params)
+            if cached is not None:
+                if self.stats is not None:
+                    self.stats.count("cache_hits")
+                calls[index] = (params, cached)
+            else:
+                calls[index] = (params, self.batcher.submit(self.TOKEN, self.method, params, VKScheduler.PAGES))
+        requeued = False
+        for index, (params, call) in sorted(calls.items()):
+            if self.cancelled.is_set():
+                return
+            fetched = None
+            try:
+                if isinstance(call, VKBatchCall):
+                    clock = time.perf_counter()
+                    response = call.result()
+                    if self.stats is not None:
+                        self.stats.add("batch_wait", time.perf_counter() - clock, 1)
+                    writer = self.cache.writer(self.TOKEN, self.method + ".json", params) if self.cache else None
+                    if writer is not None:
+                        writer.write(json.dumps(response).encode("utf-8"))
+                        writer.commit()
+                        writer.close()
+                else:
+                    try:
+                        fetched = os.fstat(call.fileno()).st_mtime
+                        response = json.loads(call.read().decode("utf-8"))
+                    finally:
+                        call.close()
+                    # the streamed pages cache the whole answer, the batched ones only the list
+                    if isinstance(response, dict):
+                        response = response["response"]
+                # the old api puts the total count before the tracks
+                if response and not isinstance(response[0], dict):
+                    self.total = int(response[0])
+                    response = response[1:]
+                results = [JSONResult(audio, fetched) for audio in response]
+            except VKApiError as e:
+                # captchas and throttling are dealt with by the ordinary page workers, see retry()
+                if e.err_code == 14 or e.err_code in self.api.THROTTLE_ERRORS:
+                    self.page_queue.put(index)
+                    requeued = True
+                    continue
+                print(e)
+                self.failed = True
+                GLib.idle_add(self.deliver, index, [], True)
+                continue
+            except Exception as e:
+                print("vk search failed:", e)
+                self.failed = True
+                GLib.idle_add(self.deliver, index, [], True)
+                continue
+            GLib.idle_add(self.deliver, index, results, True)
+        if requeued:
+            self.start_worker()
+
+    # The response is parsed while it is downloaded, tracks are sent to the main loop as soon as
+    # they are complete. Api errors raise VKApiError.
+    def fetch(self, index, offset, count):
+        params = self.params + [("offset", offset), ("count", count)]
+        # the batched pages share the cache of the json answers
+        cache_method = self.method + ".json" if self.api_format == "json" else self.method
+        response = None
+        cache_writer = None
+        fetched = None
+        if self.cache is not None:
+            if not self.force:
+                response = self.cache.open(self.TOKEN, cache_method, params)
+            if response is not None:
+                # the urls in it are as old as the file
+                fetched = os.fstat(response.fileno()).st_mtime
+                if self.stats is not None:
+                    self.stats.count("cache_hits")
+            else:
+                cache_writer = self.cache.writer(self.TOKEN, cache_method, params)
+        if response is None:
+            started = time.perf_counter()
+            response = self.api.get(self.method, self.path(params))
+            if self.stats is not None:
+                # a coalesced call has no timings of its own
+                connect, ttfb = getattr(response, "timings", (0, 0))
+                self.stats.add("http_connect", connect)
+                self.stats.add("http_ttfb", ttfb)
+                self.stats.add("http_wait", time.perf_counter() - started - connect - ttfb, 1)
+        try:
+            return self.parse(index, offset, count, response, cache_writer, fetched)
+        finally:
+            response.close()
+            if cache_writer is not None:
+                cache_writer.close()
+
+    def parse(self, index, offset, count, response, cache_writer, fetched=None):
+        reader = VKXMLReader(fetched) if self.api_format == "xml" else VKJSONReader(fetched)
+        found = 0
+        stats = self.stats
+        while not self.cancelled.is_set():
+            if stats is not None:
+                clock = time.perf_counter()
+            data = response.read(16384)
+            if stats is not None:
+                stats.add("http_body", time.perf_counter() - clock, len(data))
+                clock = time.perf_counter()
+            if not data:
+                break
+            if cache_writer is not None:
+                cache_writer.write(data)
+            # shown when there are no results
+            if index == 0 and not self.head.strip():
+                self.head = data[:1024].decode("utf-8", "replace").lstrip()
+            results = reader.feed(data)
+            if reader.total is not None:
+                self.total = reader.total
+                if index == 0:
+                    self.counted.set()
+            if stats is not None:
+                stats.add("parse", time.perf_counter() - clock, len(results))
+            if results:
+                found += len(results)
+                GLib.idle_add(self.deliver, index, results, False)
+        if self.cancelled.is_set():
+            return
+        reader.close()
+        if cache_writer is not None:
+            cache_writer.commit()
+        # a short page means the list is exhausted
+        if found < count:
+            self.total = offset + found if self.total is None else min(self.total, offset + found)
+        GLib.idle_add(self.deliver, index, [], True)
+
+    # everything below runs on the main loop
+    # pages arrive in any order, but go to the db in order
+    def deliver(self, index, results, done):
+        if self.cancelled.is_set():
+            return False
+        self.page_buffers.setdefault(index, []).extend(results)
+        if done:
+            self.pages_done.add(index)
+        while self.next_page in self.page_buffers:
+            results = self.page_buffers.pop(self.next_page)
+            self.found += len(results)
+            # every commit makes the db emit signals and refilter the query model,
+            # so the entries are committed in chunks, one chunk per main loop iteration
+            self.pending.extend(results)
+            if self.next_page not in self.pages_done:
+                break
+            self.next_page += 1
+        if self.pending and not self.inserting:
+            self.inserting = True
+            GLib.idle_add(self.insert_chunk)
+        if self.next_page == len(self.pages):
+            self.fetched()
+        return False
+
+    def insert_chunk(self):
+        if self.cancelled.is_set():
+            return False
+        added = 0
+        stats = self.stats
+        if stats is not None:
+            clock = time.perf_counter()
+        while self.pending and added < self.chunk_size:
+            location = self.add_entry(self.pending.popleft())
+            if location is not None:
+                self.locations.add(location)
+            added += 1
+        if added > 0:
+            if stats is not None:
+                committing = time.perf_counter()
+                stats.add("db_insert", committing - clock, added)
+            self.db.commit()
+            if stats is not None:
+                stats.add("db_commit", time.perf_counter() - committing, 1)
+                stats.inserted()
+            if self.on_inserted is not None:
+                self.on_inserted()
+        if self.pending:
+            return True
+        self.inserting = False
+        if self.fetching_done:
+            self.finish()
+        return False
+
+    # all the pages have been read
+    def fetched(self):
+        if self.found == 0 and not self.failed:
+            message = self.head
+            if self.total == 0:
+                message = "No results found"
             # TODO: better way of showing this to user
             d = Gtk.Dialog()
-            label = Gtk.Label(data)
+            label = Gtk.Label(message)
             d.vbox.pack_start(label, True, True, 0)
             label.show_all()
             d.run()
             d.destroy()
-        for audio in audios:
-            self.add_entry(XMLResult(audio))
+        self.fetching_done = True
+        if not self.inserting:
+            self.finish()
+
+
+# Resolves a tracklist into a playlist. Every line becomes an audio.search call sent through the
+# batcher, so up to 25 lines share a single execute request and the scheduler keeps to the rate
+# limits. The best of the candidates is picked by artist, title and duration, and the playlist
+# is filled in the order of the tracklist.
+class VKTracklistImport(VKSearchBase):
+    # candidates asked for each line
+    CANDIDATES = 10
+    # matches scoring less are left out
+    MIN_SCORE = 0.6
+    # durations further apart than this (in seconds) are different recordings
+    DURATION_SLACK = 30
+
+    def __init__(self, filename, playlist, db, entry_type, TOKEN, chunk_size=200, api=None, batcher=None,
+                 tracks=None, playback=None, index=None):
+        # (artist, title, duration or None) for each line
+        self.lines = self.read(filename)
+        VKSearchBase.__init__(self, os.path.basename(filename), str(len(self.lines)), db, entry_type, TOKEN,
+                              chunk_size=chunk_size, api=api, batcher=batcher, tracks=tracks, playback=playback,
+                              index=index)
+        if self.batcher is None:
+            self.batcher = VKBatcher(self.api)
+        self.method = "import"
+        # RB.StaticPlaylistSource the matches are added to, or None
+        self.playlist = playlist
+        # set by the source, called on the main loop with the number of resolved lines
+        self.on_progress = None
+        # line -> best result (or None), waiting for the lines before it
+        self.matches = {}
+        self.resolved = 0
+        # the next line to go to the playlist
+        self.next_line = 0
+        self.missing = []
+
+    @staticmethod
+    def read(filename):
+        with open(filename, encoding="utf-8-sig", errors="replace") as f:
+            text = f.read()
+        extension = os.path.splitext(filename)[1].lower()
+        if extension == ".csv":
+            return VKTracklistImport.read_csv(text)
+        lines = []
+        extinf = None
+        for line in text.splitlines():
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                # #EXTINF:duration,Artist - Title
+                duration, _, name = line[len("#EXTINF:"):].partition(",")
+                artist, title = VKTracklistImport.split_name(name)
+                extinf = (artist, title, VKTracklistImport.parse_duration(duration))
+            elif not line or line.startswith("#"):
+                continue
+            elif extension in (".m3u", ".m3u8"):
+                # the entries without #EXTINF only have the file name to go by
+                if extinf is None:
+                    name = os.path.splitext(os.path.basename(urllib.parse.unquote(line)))[0]
+                    extinf = VKTracklistImport.split_name(name) + (None,)
+                lines.append(extinf)
+                extinf = None
+            else:
+                lines.append(VKTracklistImport.split_name(line) + (None,))
+        return [line for line in lines if line[1]]
+
+    # columns are found by the header, if there is one. Otherwise they are artist, title and duration
+    @staticmethod
+    def read_csv(text):
+        import csv
+        rows = [row for row in csv.reader(io.StringIO(text)) if any(cell.strip() for cell in row)]
+        columns = {"artist": 0, "title": 1, "duration": 2}
+        if rows and "title" in [cell.strip().lower() for cell in rows[0]]:
+            header = [cell.strip().lower() for cell in rows.pop(0)]
+            columns = {name: header.index(name) if name in header else None for name in columns}
+
+        def cell(row, name):
+            column = columns[name]
+            return row[column].strip() if column is not None and column < len(row) else ""
+
+        lines = []
+        for row in rows:
+            artist, title = cell(row, "artist"), cell(row, "title")
+            if len(row) == 1:
+                # a single column has the whole name
+                artist, title = VKTracklistImport.split_name(row[0])
+            if title:
+                lines.append((artist, title, VKTracklistImport.parse_duration(cell(row, "duration"))))
+        return lines
+
+    # "03. Artist - Title" -> ("Artist", "Title")
+    @staticmethod
+    def split_name(name):
+        name = re.sub(r"^\d+\s*[.)]\s*", "", name.strip())
+        for separator in (" – ", " — ", " - "):
+            if separator in name:
+                artist, title = name.split(separator, 1)
+                return artist.strip(), title.strip()
+        return "", name
+
+    # seconds, or m:ss
+    @staticmethod
+    def parse_duration(text):
+        try:
+            seconds = 0
+            for part in text.strip().split(":"):
+                seconds = seconds * 60 + int(part)
+        except ValueError:
+            return None
+        return seconds if seconds > 0 else None
+
+    # lowercase words, without what is in brackets and without "feat. ..."
+    @staticmethod
+    def normalize(text):
+        text = unescape(text).lower()
+        text = re.sub(r"[(\[][^)\]]*[)\]]", " ", text)
+        text = re.sub(r"\s(feat|ft|featuring)\.?\s.*$", " ", text)
+        return " ".join(re.sub(r"[^\w]+", " ", text).split())
+
+    def score(self, line, result):
+        import difflib
+        artist, title, duration = line
+        if artist:
+            text = difflib.SequenceMatcher(None, self.normalize(title), self.normalize(result.title)).ratio() * 0.6 + \
+                difflib.SequenceMatcher(None, self.normalize(artist), self.normalize(result.artist)).ratio() * 0.4
+        else:
+            text = difflib.SequenceMatcher(None, self.normalize(title),
+                                           self.normalize(result.artist + " " + result.title)).ratio()
+        if duration is None:
+            return text
+        return text * 0.8 + max(0.0, 1 - abs(duration - result.duration) / float(self.DURATION_SLACK)) * 0.2
+
+    def best_match(self, line, results):
+        best, best_score = None, self.MIN_SCORE
+        for result in results:
+            if not result.url:
+                continue
+            score = self.score(line, result)
+            if score > best_score:
+                best, best_score = result, score
+        return best
 
-    # Starts searching
     def start(self):
-        path = "https://api.vk.com/method/audio.search.xml?auto_complete=%s&count=%s&&q=%s&access_token=%s%s" % (
-            self.search_fuzzy, self.search_num, urllib.parse.quote(self.search_line), self.TOKEN,
-            self.CAPTCHA_PARAM)
-        data = urllib.request.urlopen(path).read()
-        # vkontakte sometimes returns invalid XML with empty first line
-        data = data.lstrip()
-        xmldoc = minidom.parseString(data)
-        error = xmldoc.getElementsByTagName("error")
-        if (error) and len(error) > 0:
-            err_code = int(error[0].getElementsByTagName("error_code")[0].firstChild.nodeValue)
-            err_desc = str(error[0].getElementsByTagName("error_msg")[0].firstChild.nodeValue)
-            if (err_code == 14):  # captcha
-                captcha_sid = str(error[0].getElementsByTagName("captcha_sid")[0].firstChild.nodeValue)
-                captcha_img = str(error[0].getElementsByTagName("captcha_img")[0].firstChild.nodeValue)
-                cp_image = Gtk.Image()
-                cp_response = urllib.request.urlopen(captcha_img)
-                loader = GdkPixbuf.PixbufLoader.new_with_type('jpeg')
-                loader.write(cp_response.read())
-                loader.close()
-                cp_image.set_from_pixbuf(loader.get_pixbuf())
-                d = Gtk.Dialog(buttons=(Gtk.STOCK_OK, Gtk.ResponseType.OK))
-                cp_input = Gtk.Entry(width_chars=7, activates_default=True)
-                d.vbox.pack_start(cp_image, expand=False, fill=False, padding=0)
-                d.vbox.pack_start(cp_input, expand=False, fill=False, padding=0)
-                d.show_all()
-                d.run()
-                cp_text = cp_input.get_text()
-                d.destroy()
-                if len(cp_text) > 0:
-                    self.CAPTCHA_PARAM = "&captcha_sid=" + captcha_sid + "&captcha_key=" + cp_text
-                    self.start()  # try again till victory!
+        if not self.lines:
+            GLib.idle_add(self.fetched)
             return
-        audios = xmldoc.getElementsByTagName("audio")
-        if len(audios) == 0:
-            count = xmldoc.getElementsByTagName("count")
-            if len(count) > 0 and count[0].firstChild.nodeValue == "0":
-                data = "No results found"
-            # TODO: better way of showing this to user
-            d = Gtk.Dialog()
-            label = Gtk.Label(data)
+        worker = threading.Thread(target=self.work)
+        worker.daemon = True
+        worker.start()
+
+    # what is in brackets (live, remastered...) only makes the search miss
+    def line_params(self, line):
+        artist, title, duration = line
+        return [("q", self.normalize("%s %s" % (artist, title))), ("count", self.CANDIDATES)]
+
+    # runs in a worker thread. All the lines are submitted at once, the ones which met a captcha
+    # or the flood control go again in the next round
+    def work(self):
+        todo = list(range(len(self.lines)))
+        attempt = 0
+        while todo and not self.cancelled.is_set():
+            calls = [(i, self.batcher.submit(self.TOKEN, "audio.search", self.line_params(self.lines[i]),
+                                             VKScheduler.BACKGROUND, self.captcha)) for i in todo]
+            todo = []
+            error = None
+            for i, call in calls:
+                if self.cancelled.is_set():
+                    return
+                try:
+                    clock = time.perf_counter()
+                    response = call.result()
+                    if self.stats is not None:
+                        self.stats.add("batch_wait", time.perf_counter() - clock, 1)
+                except VKApiError as e:
+                    if e.err_code == 14 or e.err_code in self.api.THROTTLE_ERRORS:
+                        error = e
+                        todo.append(i)
+                        continue
+                    print("vk couldn't resolve %s - %s:" % self.lines[i][:2], e)
+                    response = []
+                except Exception as e:
+                    print("vk couldn't resolve %s - %s:" % self.lines[i][:2], e)
+                    response = []
+                # the old api puts the total count before the tracks
+                if response and not isinstance(response[0], dict):
+                    response = response[1:]
+                clock = time.perf_counter()
+                match = self.best_match(self.lines[i], [JSONResult(audio) for audio in response])
+                if self.stats is not None:
+                    self.stats.add("match", time.perf_counter() - clock, len(response))
+                GLib.idle_add(self.deliver, i, match)
+            if error is None:
+                continue
+            captcha = handle_api_error(self.api, error, attempt, self.cancelled)
+            attempt += 1
+            if captcha is None:
+                self.failed = True
+                for i in todo:
+                    GLib.idle_add(self.deliver, i, None)
+                return
+            if captcha:
+                self.captcha = captcha
+
+    # everything below runs on the main loop
+    # the lines are resolved in any order, but go to the playlist in order
+    def deliver(self, line, match):
+        if self.cancelled.is_set():
+            return False
+        self.matches[line] = match
+        self.resolved += 1
+        if self.on_progress is not None:
+            self.on_progress(self.resolved, len(self.lines))
+        if not self.inserting:
+            self.inserting = True
+            GLib.idle_add(self.insert_chunk)
+        return False
+
+    def insert_chunk(self):
+        if self.cancelled.is_set():
+            return False
+        stats = self.stats
+        if stats is not None:
+            clock = time.perf_counter()
+        locations = []
+        while self.next_line in self.matches and len(locations) < self.chunk_size:
+            match = self.matches.pop(self.next_line)
+            location = self.add_entry(match) if match is not None else None
+            if location is None:
+                self.missing.append(self.lines[self.next_line])
+            else:
+                # the playlist needs the entry for as long as it is there
+                self.index.pin(location)
+                locations.append(location)
+            self.next_line += 1
+        if locations:
+            self.found += len(locations)
+            if stats is not None:
+                committing = time.perf_counter()
+                stats.add("db_insert", committing - clock, len(locations))
+            self.db.commit()
+            if stats is not None:
+                stats.add("db_commit", time.perf_counter() - committing, 1)
+                stats.inserted()
+            if self.playlist is not None:
+                for location in locations:
+                    self.playlist.add_location(location, -1)
+            if self.on_inserted is not None:
+                self.on_inserted()
+        if self.next_line in self.matches:
+            return True
+        self.inserting = False
+        if self.next_line == len(self.lines):
+            self.fetched()
+        return False
+
+    def fetched(self):
+        if self.stats is not None:
+            self.stats.count("missing", len(self.missing))
+        if self.missing or not self.lines:
+            print("vk found no match for:\n" + "\n".join("  %s - %s" % line[:2] for line in self.missing))
+            d = Gtk.Dialog(buttons=(Gtk.STOCK_OK, Gtk.ResponseType.OK))
+            if self.lines:
+                label = Gtk.Label(_("Found %d of %d tracks") % (self.found, len(self.lines)))
+            else:
+                label = Gtk.Label(_("No tracks in %s") % self.search_line)
             d.vbox.pack_start(label, True, True, 0)
             label.show_all()
             d.run()
             d.destroy()
-        for audio in audios:
-            self.add_entry(XMLResult(audio))
+        self.finish()
 
 
 # The class which deals with config window
@@ -442,6 +2673,7 @@ class VKRhythmboxConfig(GObject.Object, PeasGtk.Configurable):
         self.settings = Gio.Settings.new_full(schema, None, None)
         self.API_ID = self.settings.get_string('api-id')
         self.TOKEN = self.settings.get_string('token')
+        from gi.repository import WebKit2
         grid = Gtk.Grid()
         wv = WebKit2.WebView()
         wv.load_uri(